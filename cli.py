@@ -0,0 +1,42 @@
+#!/usr/bin/python3
+
+import argparse
+import importlib
+
+# a single entry point for the tools, importing only the module of the command
+# actions of the tools with actions may be joined to the command, e.g. niftitools-header PATH as niftitools header PATH
+
+COMMANDS = [
+	("dicom2nifti", "convert a set of DICOM files to a NIfTI file"),
+	("nifti2dicom", "convert a NIfTI file to a set of DICOM files"),
+	("nifti2dicom2", "convert NIfTI files to DICOM"),
+	("dicomtools", "output the dataset of a DICOM file, or auto-adjust its brightness and contrast"),
+	("dicomsplit", "place each DICOM file in a subdirectory according to Protocol Name and Series Number"),
+	("dicomtable", "output a table with the variable fields of a DICOM set"),
+	("dicomdiff", "compare the datasets of two DICOM files"),
+	("dicomcmp", "compare the pixel data of two sets of DICOM files"),
+	("dicomsynth", "write a synthetic MR series of DICOM files"),
+	("niftitools", "output the header or the affine of a NIfTI file, or orient it"),
+	("niftidiff", "compare the headers of NIfTI files"),
+	("nifticmp", "compare the data of two NIfTI files"),
+	("proftools", "print the table of stages of saved profiles"),
+	("dicombench", "benchmark the conversion paths"),
+]
+
+def main(argv=None, prog=None):
+	parser = argparse.ArgumentParser(prog=prog, description="Run one of the tools.", epilog="\n".join(
+		["commands:"] + ["  {:<14}{}".format(name, help) for name, help in COMMANDS]
+	), formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument("command", help="one of the commands below, or a command and its action joined by a hyphen, e.g. niftitools-header", metavar="COMMAND")
+	parser.add_argument("args", nargs=argparse.REMAINDER, help="arguments of the command, see COMMAND -h", metavar="ARGS")
+	args = parser.parse_args(argv)
+	name, _, action = args.command.partition("-")
+	if name not in [name for name, help in COMMANDS]:
+		parser.error("unknown command {}".format(args.command))
+	if action:
+		args.args.insert(0, action)
+	module = importlib.import_module(name)
+	module.main(args.args, prog="{} {}".format(parser.prog, name))
+
+if __name__ == "__main__":
+	main()
@@ -3,49 +3,43 @@
 import argparse
 import os
 import datetime
+import json
+import time
+from collections import OrderedDict
+import multiprocessing
+import concurrent.futures
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import shared_memory
 
-import numpy
-import pydicom
-import nibabel
-
+import lazytools
 import dicomsplit
 import dicomtools
+import niftitools
+import proftools
 
-def dicom2nifti(dirpath, orient=False):
-	# find DICOM files
-	dicompaths = dicomtools.dir_list_files(dirpath)
-	assert len(dicompaths) >= 2, "{} does not contain at least two DICOM files".format(dirpath)
-	# read first and last DICOM files
-	dataset1 = pydicom.dcmread(dicompaths[0], stop_before_pixels=True)
-	dataset2 = pydicom.dcmread(dicompaths[-1], stop_before_pixels=True)
-	assert dataset2.InstanceNumber - dataset1.InstanceNumber + 1 == len(dicompaths)
-	# TODO datatype
-	datatype = numpy.int16
-	# calculate NIfTI affine
-	shape, zooms, affine = dicomtools.get_affine(dataset1, dataset2)
-	# build NIfTI image
-	tags = [
-		"InstanceNumber",
-		"BitsAllocated", "Rows", "Columns", "PixelRepresentation", "SamplesPerPixel", "PixelData"
-	]
-	data = numpy.zeros(shape, datatype)
-	for f, dicompath in enumerate(dicompaths):
-		print("reading [{}/{}] DICOM file {}".format(f + 1, len(dicompaths), dicompath))
-		dataset = pydicom.dcmread(dicompath, specific_tags=tags)
-		data_slice = dataset.pixel_array
-		if len(shape) == 4:
-			jinc = shape[1]
-			jbeg, jend = 0, jinc
-			iinc = shape[0]
-			ibeg, iend = 0, iinc
-			for k in range(shape[2]):
-				data[:, :, k, f] = data_slice[jbeg:jend, ibeg:iend].T
-				ibeg, iend = ibeg + iinc, iend + iinc
-				if iend > dataset1.Columns:
-					ibeg, iend = 0, iinc
-					jbeg, jend = jbeg + jinc, jend + jinc
-		else:
-			data[:, :, f] = data_slice.T
+numpy = lazytools.lazy_import("numpy")
+nibabel = lazytools.lazy_import("nibabel")
+
+def _read_slice(data, f, dicompath, profile=None):
+	# data is Fortran-ordered, thus data.T[f] is a C-contiguous DICOM slice or set of mosaic tiles
+	if data.ndim == 4:
+		data_slice = dicomtools.file_read_pixel_array(dicompath)
+		with proftools.stage(profile, "mosaic"):
+			data.T[f] = dicomtools.mosaic_untile(data_slice, data.shape[1], data.shape[0], data.shape[2])
+	else:
+		dicomtools.file_read_pixel_array(dicompath, out=data.T[f])
+
+# state of a worker process, set by _worker_init
+_worker = {}
+
+def _worker_init(name, shape, dtype):
+	_worker["shm"] = shared_memory.SharedMemory(name=name)
+	_worker["data"] = numpy.ndarray(shape, dtype, buffer=_worker["shm"].buf, order="F")
+
+def _worker_read_slice(f, dicompath):
+	_read_slice(_worker["data"], f, dicompath)
+
+def _write_nifti(data, dataset1, zooms, affine, dirpath, orient, level, jobs, profile=None, quiet=False):
 	# create NIfTI object
 	nifti = nibabel.Nifti1Image(data, affine)
 	# build NIfTI header
@@ -66,34 +60,261 @@ def dicom2nifti(dirpath, orient=False):
 	nifti.header["glmin"] = 0      # unused, normally data.min()
 	# NOTE descrip
 	# NOTE qform_code, sform_code
-	if orient:
-		nifti = nibabel.as_closest_canonical(nifti)
-	else:
-		# apply default NIfTI transformation
-		ornt = numpy.array([[0, 1], [1, -1], [2, 1]])
-		if numpy.linalg.det(affine[:3, :3]) < 0:
-			ornt[2, 1] = -1
-		nifti = nifti.as_reoriented(ornt)
+	with proftools.stage(profile, "reorient"):
+		if orient:
+			nifti = nibabel.as_closest_canonical(nifti)
+		else:
+			# apply default NIfTI transformation
+			ornt = numpy.array([[0, 1], [1, -1], [2, 1]])
+			if numpy.linalg.det(affine[:3, :3]) < 0:
+				ornt[2, 1] = -1
+			nifti = nifti.as_reoriented(ornt)
 	# save NIfTI file
-	niftiname = dicomtools.get_series(dataset1) + datetime.datetime.now().strftime("-%Y%m%d%H%M%S") + ".nii.gz"
+	niftiname = dicomtools.get_series(dataset1) + datetime.datetime.now().strftime("-%Y%m%d%H%M%S") + (".nii.gz" if level else ".nii")
 	niftipath = os.path.join(dirpath, niftiname)
 	assert not os.path.exists(niftipath)
-	print("writing NIfTI file {}".format(niftipath))
-	nibabel.save(nifti, niftipath)
-	print("dicom2nifti complete")
+	if not quiet:
+		print("writing NIfTI file {}".format(niftipath))
+	with proftools.stage(profile, "write", files=1) as counts:
+		niftitools.save(nifti, niftipath, level=level, jobs=jobs, profile=profile)
+		counts["bytes_written"] = os.path.getsize(niftipath)
+	return niftipath
 
-if __name__ == "__main__":
-	parser = argparse.ArgumentParser(description="Convert a set of DICOM files to a NIfTI file.")
-	parser.add_argument("path", help="directory of DICOM files", metavar="PATH")
+def _convert(dicompaths, dirpath, orient, jobs, level, profile=None, quiet=False, mp_context=None):
+	# convert the DICOM files of a series, sorted by Instance Number, to a NIfTI file in dirpath
+	# mp_context is the multiprocessing context of the worker processes, by default fork
+	with proftools.stage(profile, "header", files=2):
+		# read first and last DICOM files
+		dataset1 = dicomtools.dcmread(dicompaths[0], stop_before_pixels=True)
+		dataset2 = dicomtools.dcmread(dicompaths[-1], stop_before_pixels=True)
+		assert dataset2.InstanceNumber - dataset1.InstanceNumber + 1 == len(dicompaths)
+		# (0x0028, 0x0100) & (0x0028, 0x0103) Bits Allocated & Pixel Representation
+		datatype = dicomtools.get_dtype(dataset1)
+		# calculate NIfTI affine
+		shape, zooms, affine = dicomtools.get_affine(dataset1, dataset2)
+		shape = tuple(int(n) for n in shape)
+	# build NIfTI image
+	# the shared memory volume is unlinked whatever happens, e.g. a truncated DICOM file failing a worker
+	shm = None
+	try:
+		with proftools.stage(profile, "decode", files=len(dicompaths), bytes_read=int(numpy.prod(shape)) * numpy.dtype(datatype).itemsize):
+			if jobs > 1:
+				# worker processes decode DICOM files directly into a shared memory volume
+				shm = shared_memory.SharedMemory(create=True, size=int(numpy.prod(shape)) * numpy.dtype(datatype).itemsize)
+				data = numpy.ndarray(shape, datatype, buffer=shm.buf, order="F")
+				data.fill(0)
+				chunksize = max(1, len(dicompaths) // (4 * jobs))
+				with concurrent.futures.ProcessPoolExecutor(jobs, mp_context=mp_context, initializer=_worker_init, initargs=(shm.name, shape, datatype)) as executor:
+					results = executor.map(_worker_read_slice, range(len(dicompaths)), dicompaths, chunksize=chunksize)
+					for f, result in enumerate(results):
+						if not quiet:
+							print("reading [{}/{}] DICOM file {}".format(f + 1, len(dicompaths), dicompaths[f]))
+			else:
+				data = numpy.zeros(shape, datatype, order="F")
+				for f, dicompath in enumerate(dicompaths):
+					if not quiet:
+						print("reading [{}/{}] DICOM file {}".format(f + 1, len(dicompaths), dicompath))
+					_read_slice(data, f, dicompath, profile=profile)
+		niftipath = _write_nifti(data, dataset1, zooms, affine, dirpath, orient, level, jobs, profile=profile, quiet=quiet)
+	finally:
+		if shm is not None:
+			shm.unlink()
+	if shm is not None:
+		del data
+		shm.close()
+	if not quiet:
+		print("dicom2nifti complete")
+	return niftipath
+
+def dicom2nifti(path, orient=False, index=True, jobs=1, level=niftitools.GZIP_LEVEL, profile=None, quiet=False):
+	# level 0 writes an uncompressed .nii file
+	# find DICOM files of a directory or a manifest
+	with proftools.stage(profile, "scan") as counts:
+		dicompaths = dicomtools.dir_list_files(path, index=index, jobs=jobs)
+		counts["files"] = len(dicompaths)
+	assert len(dicompaths) >= 2, "{} does not contain at least two DICOM files".format(path)
+	dirpath = os.path.dirname(path) if os.path.isfile(path) else path
+	return _convert(dicompaths, dirpath, orient, jobs, level, profile=profile, quiet=quiet)
+
+def dicom2nifti_direct(path, orient=False, index=True, jobs=1, level=niftitools.GZIP_LEVEL, series_jobs=1, profile=None, quiet=False):
+	# convert each series of a directory, archive or manifest of mixed DICOM files with a single scan,
+	# grouping the DICOM files by series in memory, thus they are neither copied, linked nor scanned again
+	# NIfTI files are written to the directory, or next to the archive or manifest, as by dicomsplit --virtual
+	# series_jobs series are converted concurrently by a pool of threads
+	# worker processes are then started by a fork server, since a process forked by a thread may inherit a lock held by
+	# another thread, e.g. of an open archive or a lazy module, and deadlock
+	with proftools.stage(profile, "scan") as counts:
+		headers = dicomtools.dir_scan(path, index=index, jobs=jobs)
+		counts["files"] = len(headers)
+	series = OrderedDict()
+	for filepath, header in headers:
+		if header.get("InstanceNumber") is not None:
+			series.setdefault(dicomtools.get_series(header), []).append((header["InstanceNumber"], filepath))
+	if not quiet:
+		print("found {} DICOM files with {} different series".format(sum(len(files) for files in series.values()), len(series)))
+	for aseries, files in series.items():
+		assert len(files) >= 2, "series {} does not contain at least two DICOM files".format(aseries)
+	dirpath = path if os.path.isdir(path) else os.path.dirname(path)
+	mp_context = None
+	if series_jobs > 1 and jobs > 1:
+		# the fork server imports the modules of the workers once, rather than each worker of each series
+		mp_context = multiprocessing.get_context("forkserver")
+		mp_context.set_forkserver_preload(["numpy", "pydicom", "dicomtools"])
+	def convert(files):
+		return _convert([filepath for instance, filepath in sorted(files)], dirpath, orient, jobs, level, profile=profile, quiet=quiet, mp_context=mp_context)
+	if series_jobs > 1:
+		with ThreadPoolExecutor(series_jobs) as executor:
+			return list(executor.map(convert, series.values()))
+	return [convert(files) for files in series.values()]
+
+
+#########
+# watch #
+#########
+
+# a drop directory is polled and each series is converted once it is complete
+# a series is complete when its Instance Numbers are contiguous, its number of files agrees with the number of images
+# or temporal positions of its DICOM header if any, and its files have not changed for a settle period
+# converted series are recorded in a state file, thus a restarted watch does not convert them again
+
+WATCH_STATE_FILENAME = ".dicomwatch.json"
+
+def _watch_state_load(path):
+	try:
+		with open(os.path.join(path, WATCH_STATE_FILENAME)) as fp:
+			return json.load(fp)
+	except (OSError, ValueError):
+		return {}
+
+def _watch_state_save(path, state):
+	statepath = os.path.join(path, WATCH_STATE_FILENAME)
+	with open(statepath + ".tmp", "w") as fp:
+		json.dump(state, fp, indent=1, sort_keys=True)
+	os.replace(statepath + ".tmp", statepath)
+
+def _watch_is_complete(files):
+	# files: list of (filepath, header) of a series
+	instances = sorted(header["InstanceNumber"] for filepath, header in files)
+	if len(files) < 2 or instances[-1] - instances[0] + 1 != len(files) or len(set(instances)) != len(files):
+		return False
+	dataset1 = dicomtools.dcmread(min(files, key=lambda f: f[1]["InstanceNumber"])[0], stop_before_pixels=True)
+	dataset2 = dicomtools.dcmread(max(files, key=lambda f: f[1]["InstanceNumber"])[0], stop_before_pixels=True)
+	shape, zooms, affine = dicomtools.get_affine(dataset1, dataset2)
+	# the last dimension of shape is counted from the Instance Numbers, thus the expected number of files is taken
+	# from (0x0020, 0x0105) Number of Temporal Positions for a mosaic, or (0x0020, 0x1002) Images in Acquisition
+	count = dataset1.get("NumberOfTemporalPositions" if len(shape) == 4 else "ImagesInAcquisition")
+	return count is None or int(count) == len(files)
+
+def _watch_signature(files):
+	stats = [os.stat(filepath) for filepath, header in files]
+	return [len(files), sum(stat.st_size for stat in stats), max(stat.st_mtime_ns for stat in stats)]
+
+def watch(path, orient=False, index=True, jobs=1, level=niftitools.GZIP_LEVEL, interval=2, settle=10, once=False, profile=None, quiet=False):
+	assert os.path.isdir(path), "{} is not a directory".format(path)
+	state = _watch_state_load(path)
+	# signature of each pending series and the time it was first seen
+	pending = {}
+	print("watching directory {}".format(path))
+	while True:
+		series = {}
+		for filepath, header in dicomtools.dir_scan(path, index=index, jobs=jobs):
+			if all(header.get(tag) is not None for tag in ["InstanceNumber", "SeriesNumber", "ProtocolName"]):
+				series.setdefault(dicomtools.get_series(header), []).append((filepath, header))
+		for aseries, files in sorted(series.items()):
+			if aseries in state and state[aseries]["count"] == len(files):
+				continue
+			try:
+				if not _watch_is_complete(files):
+					pending.pop(aseries, None)
+					continue
+				signature = _watch_signature(files)
+			except (OSError, AttributeError, KeyError, IndexError, TypeError, ValueError):
+				# e.g. a DICOM file removed or still being written
+				pending.pop(aseries, None)
+				continue
+			if aseries not in pending or pending[aseries][0] != signature:
+				pending[aseries] = (signature, time.time())
+				continue
+			if time.time() - pending[aseries][1] < settle:
+				continue
+			# convert the series through a manifest, leaving the DICOM files in place
+			del pending[aseries]
+			manifestpath = os.path.join(path, aseries + dicomtools.MANIFEST_EXT)
+			dicomtools.manifest_write(manifestpath, [filepath for filepath, header in files])
+			print("converting series {} of {} DICOM files".format(aseries, len(files)))
+			try:
+				niftipath = dicom2nifti(manifestpath, orient=orient, index=index, jobs=jobs, level=level, profile=profile, quiet=quiet)
+				state[aseries] = {"count": len(files), "nifti": os.path.basename(niftipath)}
+			except Exception as e:
+				# the series is tried again only if its number of DICOM files changes
+				print("failed to convert series {}: {}".format(aseries, e))
+				state[aseries] = {"count": len(files), "error": str(e)}
+			_watch_state_save(path, state)
+		if once and not pending:
+			break
+		time.sleep(interval)
+
+def main(argv=None, prog=None):
+	parser = argparse.ArgumentParser(prog=prog, description="Convert a set of DICOM files to a NIfTI file.")
+	parser.add_argument("path", help="directory or archive of DICOM files, or manifest of a series", metavar="PATH")
 	parser.add_argument("-o", "--orient", action="store_true", help="orient output NIfTI file")
-	args = parser.parse_args()
-	assert os.path.isdir(args.path), "{} is not a directory".format(args.path)
-	# split DICOM files
-	series = dicomsplit.split(args.path, single=False, verbose=True)
-	if len(series) > 1:
-		dirpaths = [os.path.join(args.path, aseries) for aseries in series]
+	group = parser.add_mutually_exclusive_group()
+	group.add_argument("-l", "--link", choices=["hard", "sym", "reflink"], help="split series by linking files instead of copying")
+	group.add_argument("--virtual", action="store_true", help="split series by writing manifests instead of copying files")
+	group.add_argument("--direct", action="store_true", help="convert each series directly from the DICOM files with a single scan, without splitting")
+	parser.add_argument("--no-index", action="store_false", help="do not use the header index of the directories", dest="index")
+	parser.add_argument("-z", "--level", type=int, default=niftitools.GZIP_LEVEL, help="gzip compression level of the output NIfTI files; 0 writes uncompressed .nii files; default {}".format(niftitools.GZIP_LEVEL))
+	parser.add_argument("-w", "--watch", action="store_true", help="watch PATH and convert each series once it is complete")
+	parser.add_argument("--interval", type=float, default=2, help="seconds between polls of the watched directory; default 2")
+	parser.add_argument("--settle", type=float, default=10, help="seconds a complete series must remain unchanged before conversion; default 10")
+	parser.add_argument("--once", action="store_true", help="stop watching once no complete series is pending")
+	parser.add_argument("-j", "--jobs", type=int, default=1, help="number of threads reading DICOM headers and compressing NIfTI files, and of worker processes decoding DICOM files; default 1")
+	parser.add_argument("--series-jobs", type=int, default=1, help="number of series converted concurrently with --direct; default 1")
+	parser.add_argument("-q", "--quiet", action="store_true", help="print a throughput summary instead of a line per file")
+	parser.add_argument("--profile", action="store_true", help="print the time, files and bytes of each stage")
+	parser.add_argument("--stats-json", help="save the time, files and bytes of each stage to a JSON file", metavar="PATH")
+	args = parser.parse_args(argv)
+	profile = proftools.new() if args.quiet or args.profile or args.stats_json else None
+	if args.watch:
+		try:
+			watch(args.path, orient=args.orient, index=args.index, jobs=args.jobs, level=args.level, interval=args.interval, settle=args.settle, once=args.once, profile=profile, quiet=args.quiet)
+		finally:
+			if args.profile:
+				proftools.report(profile)
+			if args.stats_json:
+				proftools.save(profile, args.stats_json)
+		return
+	if args.direct:
+		dicom2nifti_direct(args.path, orient=args.orient, index=args.index, jobs=args.jobs, level=args.level, series_jobs=args.series_jobs, profile=profile, quiet=args.quiet)
 	else:
-		dirpaths = [args.path]
-	# convert DICOM files
-	for dirpath in dirpaths:
-		dicom2nifti(dirpath, orient=args.orient)
+		if dicomtools.archive_is_valid(args.path):
+			# split an archive by writing manifests next to it, thus members are never extracted
+			# the manifests of a previous conversion of the archive are overwritten, since they list the same members
+			series = dicomsplit.split(args.path, force=True, single=False, verbose=not args.quiet, index=args.index, virtual=True, jobs=args.jobs, profile=profile)
+			if len(series) > 1:
+				dirpaths = [os.path.join(os.path.dirname(args.path), aseries + dicomtools.MANIFEST_EXT) for aseries in series]
+			else:
+				dirpaths = [args.path]
+		elif os.path.isfile(args.path):
+			# manifest of a single series
+			dirpaths = [args.path]
+		else:
+			assert os.path.isdir(args.path), "{} is neither a directory, an archive nor a manifest".format(args.path)
+			# split DICOM files
+			series = dicomsplit.split(args.path, single=False, verbose=not args.quiet, index=args.index, link=args.link, virtual=args.virtual, jobs=args.jobs, profile=profile)
+			if len(series) > 1:
+				dirpaths = [os.path.join(args.path, aseries + (dicomtools.MANIFEST_EXT if args.virtual else "")) for aseries in series]
+			else:
+				dirpaths = [args.path]
+		# convert DICOM files
+		for dirpath in dirpaths:
+			dicom2nifti(dirpath, orient=args.orient, index=args.index, jobs=args.jobs, level=args.level, profile=profile, quiet=args.quiet)
+	if args.profile:
+		proftools.report(profile)
+	elif args.quiet:
+		print(proftools.summary(profile, "decode"))
+	if args.stats_json:
+		proftools.save(profile, args.stats_json)
+
+if __name__ == "__main__":
+	main()
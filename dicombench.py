@@ -0,0 +1,436 @@
+#!/usr/bin/python3
+
+import argparse
+import os
+import sys
+import io
+import math
+import time
+import timeit
+import datetime
+import json
+import shutil
+import tempfile
+import subprocess
+import contextlib
+from collections import OrderedDict
+
+import importlib
+
+import lazytools
+
+numpy = lazytools.lazy_import("numpy")
+pydicom = lazytools.lazy_import("pydicom")
+
+# the benchmarked tools are imported on first use too, thus dicombench -h is as fast as the tools
+cli = lazytools.lazy_import("cli")
+dicom2nifti = lazytools.lazy_import("dicom2nifti")
+dicomsplit = lazytools.lazy_import("dicomsplit")
+dicomsynth = lazytools.lazy_import("dicomsynth")
+dicomtable = lazytools.lazy_import("dicomtable")
+dicomtools = lazytools.lazy_import("dicomtools")
+nifti2dicom = lazytools.lazy_import("nifti2dicom")
+nifti2dicom2 = lazytools.lazy_import("nifti2dicom2")
+
+def _best(func, repeat):
+	# best wall time of a single call, in seconds
+	return min(timeit.repeat(func, number=1, repeat=repeat))
+
+def _report(name, loop, vectorized):
+	print("{}\t{:.6f}\t{:.6f}\t{:.1f}".format(name, loop, vectorized, loop / vectorized))
+
+
+##########
+# mosaic #
+##########
+
+# per-slice loops formerly used by dicom2nifti, nifti2dicom and nifti2dicom2
+
+def _mosaic_untile_loop(mosaic, rows, columns, nslices):
+	tiles = numpy.zeros((nslices, rows, columns), mosaic.dtype)
+	jinc = rows
+	jbeg, jend = 0, jinc
+	iinc = columns
+	ibeg, iend = 0, iinc
+	for k in range(nslices):
+		tiles[k] = mosaic[jbeg:jend, ibeg:iend]
+		ibeg, iend = ibeg + iinc, iend + iinc
+		if iend > mosaic.shape[1]:
+			ibeg, iend = 0, iinc
+			jbeg, jend = jbeg + jinc, jend + jinc
+	return tiles
+
+def _mosaic_tile_loop(tiles, Rows, Columns):
+	mosaic = numpy.zeros((Rows, Columns), tiles.dtype)
+	jinc = tiles.shape[1]
+	jbeg, jend = 0, jinc
+	iinc = tiles.shape[2]
+	ibeg, iend = 0, iinc
+	for k in range(tiles.shape[0]):
+		mosaic[jbeg:jend, ibeg:iend] = tiles[k]
+		ibeg, iend = ibeg + iinc, iend + iinc
+		if iend > Columns:
+			ibeg, iend = 0, iinc
+			jbeg, jend = jbeg + jinc, jend + jinc
+	return mosaic
+
+def bench_mosaic(nslices=64, rows=64, columns=64, nvolumes=100, repeat=5):
+	nblocks = math.ceil(math.sqrt(nslices))
+	Rows, Columns = nblocks * rows, nblocks * columns
+	mosaics = numpy.random.RandomState(0).randint(-1000, 1000, (nvolumes, Rows, Columns)).astype(numpy.int16)
+	tiles = dicomtools.mosaic_untile(mosaics, rows, columns, nslices)
+	# check against the loops
+	for mosaic, volume in zip(mosaics, tiles):
+		assert numpy.array_equal(_mosaic_untile_loop(mosaic, rows, columns, nslices), volume)
+		assert numpy.array_equal(_mosaic_tile_loop(volume, Rows, Columns), dicomtools.mosaic_tile(volume, Rows, Columns))
+	assert numpy.array_equal(numpy.stack([_mosaic_tile_loop(volume, Rows, Columns) for volume in tiles]), dicomtools.mosaic_tile(tiles, Rows, Columns))
+	print("# mosaic: {} volumes of {} slices of {}x{} pixels".format(nvolumes, nslices, rows, columns))
+	print("name\tloop\tvectorized\tspeedup")
+	_report("untile",
+		_best(lambda: _mosaic_untile_loop(mosaics[0], rows, columns, nslices), repeat),
+		_best(lambda: dicomtools.mosaic_untile(mosaics[0], rows, columns, nslices), repeat),
+	)
+	_report("untile-batch",
+		_best(lambda: [_mosaic_untile_loop(mosaic, rows, columns, nslices) for mosaic in mosaics], repeat),
+		_best(lambda: dicomtools.mosaic_untile(mosaics, rows, columns, nslices), repeat),
+	)
+	_report("tile",
+		_best(lambda: _mosaic_tile_loop(tiles[0], Rows, Columns), repeat),
+		_best(lambda: dicomtools.mosaic_tile(tiles[0], Rows, Columns), repeat),
+	)
+	_report("tile-batch",
+		_best(lambda: [_mosaic_tile_loop(volume, Rows, Columns) for volume in tiles], repeat),
+		_best(lambda: dicomtools.mosaic_tile(tiles, Rows, Columns), repeat),
+	)
+
+
+########
+# csa2 #
+########
+
+# byte-by-byte codec formerly used by dicomtools
+
+def _csa2_decode_ref(arr):
+	assert arr[0:4] == b"SV10"
+	ntags = int.from_bytes(arr[8:12], "little")
+	i = 16
+	hdr = OrderedDict()
+	for ctags in range(0, ntags):
+		key = arr[i:i+64].split(bytes(1), 1)[0].decode()
+		hdr[key] = {}
+		hdr[key]["VM"] = int.from_bytes(arr[i+64:i+68], "little")
+		hdr[key]["VR"] = arr[i+68:i+72].split(bytes(1), 1)[0].decode()
+		hdr[key]["SyngoDT"] = int.from_bytes(arr[i+72:i+76], "little")
+		nitems = int.from_bytes(arr[i+76:i+80], "little")
+		i += 84
+		hdr[key]["Data"] = []
+		for citems in range(nitems):
+			item_len = int.from_bytes(arr[i:i+4], "little")
+			if item_len:
+				hdr[key]["Data"].append(arr[i+16:i+16+item_len].split(bytes(1), 1)[0].decode())
+			else:
+				hdr[key]["Data"].append(None)
+			i += 16 + math.ceil(item_len / 4) * 4
+	return hdr
+
+def _csa2_encode_ref(hdr):
+	arr = b""
+	arr += b"SV10"
+	arr += bytes(4)
+	arr += len(hdr).to_bytes(4, "little")
+	arr += bytes(4)
+	for key, val in hdr.items():
+		arr += key.encode().ljust(64, bytes(1))
+		arr += val["VM"].to_bytes(4, "little")
+		arr += val["VR"].encode().ljust(4, bytes(1))
+		arr += val["SyngoDT"].to_bytes(4, "little")
+		arr += len(val["Data"]).to_bytes(4, "little")
+		arr += bytes(4)
+		for dat in val["Data"]:
+			item_len = len(dat) + 1 if dat is not None else 0
+			arr += item_len.to_bytes(4, "little")
+			arr += bytes(12)
+			if item_len:
+				arr += dat.encode().ljust(math.ceil(item_len / 4) * 4, bytes(1))
+	arr += bytes(4)
+	return arr
+
+def _csa2_synthetic(ntags):
+	# header resembling a Siemens CSA Image Header Info, with a few items per tag
+	hdr = OrderedDict()
+	for k in range(ntags):
+		nitems = k % 4
+		hdr["Tag{:03d}".format(k)] = {"VM": nitems, "VR": "DS", "SyngoDT": 3, "Data": [("{:.8f}".format(k * 1.5 + c) if c % 3 else None) for c in range(nitems)]}
+	hdr["NumberOfImagesInMosaic"] = {"VM": 1, "VR": "US", "SyngoDT": 10, "Data": ["64"]}
+	hdr["SliceNormalVector"] = {"VM": 3, "VR": "FD", "SyngoDT": 4, "Data": ["0.00000000", "0.00000000", "1.00000000"]}
+	return hdr
+
+def _csa2_check(arr):
+	# check the codec against the reference on an encoded header
+	hdr = dicomtools.csa2_decode(arr)
+	assert hdr == _csa2_decode_ref(arr)
+	assert dicomtools.csa2_encode(hdr) == _csa2_encode_ref(hdr)
+	assert dicomtools.csa2_decode(dicomtools.csa2_encode(hdr)) == hdr
+	# patching the encoded header in place must match encoding it again
+	keys = list(hdr.keys())[::2]
+	patched = bytearray(dicomtools.csa2_encode(hdr))
+	offsets = dicomtools.csa2_offsets(patched)
+	for key in keys:
+		hdr[key]["Data"] = [dat[::-1] if dat is not None else None for dat in hdr[key]["Data"]]
+	assert dicomtools.csa2_patch(patched, offsets, hdr, keys)
+	assert bytes(patched) == dicomtools.csa2_encode(hdr)
+	return hdr
+
+def bench_csa2(dicompaths=[], ntags=100, repeat=5):
+	arr = bytes(dicomtools.csa2_encode(_csa2_synthetic(ntags)))
+	_csa2_check(arr)
+	for dicompath in dicompaths:
+		dataset = pydicom.dcmread(dicompath, stop_before_pixels=True)
+		for tag in [(0x0029, 0x1010), (0x0029, 0x1020)]:
+			if tag in dataset:
+				_csa2_check(dataset[tag].value)
+				print("# checked {} {}".format(dicompath, pydicom.tag.Tag(tag)))
+	hdr = dicomtools.csa2_decode(arr)
+	keys = ["NumberOfImagesInMosaic", "SliceNormalVector"]
+	patched = bytearray(arr)
+	offsets = dicomtools.csa2_offsets(patched)
+	print("# csa2: {} tags, {} bytes".format(len(hdr), len(arr)))
+	print("name\tbytewise\tstruct\tspeedup")
+	_report("decode",
+		_best(lambda: _csa2_decode_ref(arr), repeat),
+		_best(lambda: dicomtools.csa2_decode(arr), repeat),
+	)
+	_report("decode-keys",
+		_best(lambda: _csa2_decode_ref(arr), repeat),
+		_best(lambda: dicomtools.csa2_decode(arr, keys=keys), repeat),
+	)
+	_report("encode",
+		_best(lambda: _csa2_encode_ref(hdr), repeat),
+		_best(lambda: dicomtools.csa2_encode(hdr), repeat),
+	)
+	_report("patch",
+		_best(lambda: _csa2_encode_ref(hdr), repeat),
+		_best(lambda: dicomtools.csa2_patch(patched, offsets, hdr, keys), repeat),
+	)
+
+
+#######
+# rle #
+#######
+
+def _rle_synthetic(nframes, size):
+	# slices resembling MR images: an empty background around a noisy disk
+	random = numpy.random.RandomState(0)
+	y, x = numpy.mgrid[:size, :size] - size / 2
+	disk = numpy.hypot(x, y) < size * 0.4
+	frames = numpy.zeros((nframes, size, size), numpy.int16)
+	frames[:, disk] = random.randint(200, 1200, (nframes, int(disk.sum())))
+	return frames
+
+def _rle_check(arr):
+	# check the encoder against the pydicom encoder, and the decoded frame against the array
+	# the pydicom encoder is a submodule, which lazy_import imports at once, thus it is imported on use
+	rle_handler = importlib.import_module("pydicom.pixel_data_handlers.rle_handler")
+	frame = dicomtools.rle_encode_frame(arr)
+	assert frame == rle_handler.rle_encode_frame(arr)
+	decoded = rle_handler._rle_decode_frame(frame, arr.shape[0], arr.shape[1], 1, arr.dtype.itemsize * 8)
+	assert numpy.array_equal(numpy.frombuffer(decoded, arr.dtype.newbyteorder("<")).reshape(arr.shape), arr)
+	return frame
+
+def bench_rle(dicompaths=[], nframes=10, size=256, repeat=5):
+	rle_handler = importlib.import_module("pydicom.pixel_data_handlers.rle_handler")
+	# the encoder is tested by tests/test_rle.py, only the frames of the given DICOM files are checked here
+	frames = _rle_synthetic(nframes, size)
+	for dicompath in dicompaths:
+		dataset = dicomtools.dcmread(dicompath)
+		arr = dataset.pixel_array
+		for frame in arr.reshape((-1,) + arr.shape[-2:]):
+			_rle_check(frame)
+		print("# checked {}".format(dicompath))
+	nbytes = sum(len(dicomtools.rle_encode_frame(arr)) for arr in frames)
+	print("# rle: {} frames of {}x{} pixels, compression ratio {:.2f}".format(nframes, size, size, frames.nbytes / nbytes))
+	print("name\tpydicom\tvectorized\tspeedup")
+	_report("encode",
+		_best(lambda: rle_handler.rle_encode_frame(frames[0]), repeat),
+		_best(lambda: dicomtools.rle_encode_frame(frames[0]), repeat),
+	)
+	_report("encode-batch",
+		_best(lambda: [rle_handler.rle_encode_frame(arr) for arr in frames], repeat),
+		_best(lambda: [dicomtools.rle_encode_frame(arr) for arr in frames], repeat),
+	)
+
+
+###########
+# startup #
+###########
+
+# cold start of command lines of cli.py, each run by a new interpreter, thus including the imports of the command
+
+def _startup_commands(dicompath=None, niftipath=None):
+	commands = [("python", None)] + [(name, [name, "-h"]) for name, help in cli.COMMANDS]
+	if dicompath is not None:
+		commands.append(("dicomtools-dataset", ["dicomtools", "dataset", dicompath]))
+	if niftipath is not None:
+		commands.append(("niftitools-header", ["niftitools", "header", niftipath]))
+	return commands
+
+def _startup(args, repeat):
+	# None as args measures the startup of python itself
+	argv = [sys.executable] + ([os.path.join(os.path.dirname(os.path.abspath(__file__)), "cli.py")] + args if args is not None else ["-c", "pass"])
+	def run():
+		subprocess.run(argv, stdout=subprocess.DEVNULL, check=True)
+	return _best(run, repeat)
+
+def bench_startup(dicompath=None, niftipath=None, repeat=5):
+	print("command\tseconds")
+	results = []
+	for name, args in _startup_commands(dicompath, niftipath):
+		results.append((name, _startup(args, repeat)))
+		print("{}\t{:.3f}".format(*results[-1]))
+	return results
+
+#########
+# suite #
+#########
+
+# throughput of the conversion paths on synthetic series written by dicomsynth, and cold start of the command lines
+# results are appended to a JSON lines file with the git commit, and compared with the last results of another commit
+
+def _git_commit():
+	try:
+		return subprocess.run(["git", "describe", "--always", "--dirty"], cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True, check=True).stdout.strip()
+	except (OSError, subprocess.CalledProcessError):
+		return None
+
+def _run_clean(dirpath, func):
+	# wall time of func, which is run silently; the files and directories it creates in dirpath are then removed
+	before = set(os.listdir(dirpath))
+	try:
+		with contextlib.redirect_stdout(io.StringIO()):
+			start = time.perf_counter()
+			func()
+			return time.perf_counter() - start
+	finally:
+		for name in set(os.listdir(dirpath)) - before:
+			path = os.path.join(dirpath, name)
+			if os.path.isdir(path):
+				shutil.rmtree(path)
+			else:
+				os.remove(path)
+
+def _best_clean(dirpath, func, repeat):
+	return min(_run_clean(dirpath, func) for r in range(repeat))
+
+def _suite_previous(output, commit, parameters):
+	# results of the last run of another commit with the same parameters
+	previous = None
+	if output is not None and os.path.isfile(output):
+		with open(output) as fp:
+			for line in fp:
+				entry = json.loads(line)
+				if entry["commit"] != commit and entry["parameters"] == parameters:
+					previous = entry
+	if previous is None:
+		return {}
+	return {(result["kind"], result["name"]): result for result in previous["results"]}
+
+def bench_suite(kinds=None, nslices=64, size=256, nvolumes=16, repeat=3, jobs=1, output=None):
+	# all kinds by default, resolved here since a default argument would load dicomsynth on import
+	kinds = kinds or dicomsynth.KINDS
+	commit = _git_commit()
+	parameters = {"nslices": nslices, "size": size, "nvolumes": nvolumes, "jobs": jobs}
+	previous = _suite_previous(output, commit, parameters)
+	results = []
+	print("# suite: commit {}, {} slices of {}x{} pixels, {} mosaic volumes, {} jobs".format(commit, nslices, size, size, nvolumes, jobs))
+	print("kind\tname\tfiles\tMB\tseconds\tfiles/s\tMB/s\tspeedup")
+	def report(kind, name, files, nbytes, seconds):
+		result = {"kind": kind, "name": name, "files": files, "MB": nbytes / 1e6, "seconds": seconds}
+		results.append(result)
+		speedup = previous[kind, name]["seconds"] / seconds if (kind, name) in previous else float("nan")
+		print("{}\t{}\t{}\t{:.1f}\t{:.3f}\t{:.1f}\t{:.1f}\t{:.2f}".format(kind, name, files, result["MB"], seconds, files / seconds, result["MB"] / seconds, speedup))
+	tmppath = tempfile.mkdtemp(prefix="dicombench-")
+	try:
+		for kind in kinds:
+			seriespath = os.path.join(tmppath, kind)
+			dicompaths = dicomsynth.synth(seriespath, kind, nslices=nslices, size=size, nvolumes=nvolumes)
+			nbytes = sum(os.path.getsize(dicompath) for dicompath in dicompaths)
+			report(kind, "dicom2nifti", len(dicompaths), nbytes, _best_clean(seriespath,
+				lambda: dicom2nifti.dicom2nifti(seriespath, index=False, jobs=jobs, quiet=True), repeat))
+			report(kind, "dicomtable", len(dicompaths), nbytes, _best_clean(seriespath,
+				lambda: dicomtable.table(seriespath, fp=io.StringIO(), index=False, jobs=jobs), repeat))
+			# the NIfTI file is kept for nifti2dicom
+			with contextlib.redirect_stdout(io.StringIO()):
+				niftipath = dicom2nifti.dicom2nifti(seriespath, index=False, quiet=True)
+			report(kind, "nifti2dicom", len(dicompaths), nbytes, _best_clean(seriespath,
+				lambda: nifti2dicom.nifti2dicom(niftipath, jobs=jobs, quiet=True), repeat))
+			report(kind, "nifti2dicom2", len(dicompaths), nbytes, _best_clean(seriespath,
+				lambda: nifti2dicom2.nifti2dicom(niftipath, jobs=jobs, quiet=True), repeat))
+			# two series of the kind
+			mixedpath = os.path.join(tmppath, kind + "-mixed")
+			mixedpaths = dicomsynth.synth(mixedpath, kind, nslices=nslices, size=size, nvolumes=nvolumes, series=1, protocol=kind + "A")
+			mixedpaths += dicomsynth.synth(mixedpath, kind, nslices=nslices, size=size, nvolumes=nvolumes, seed=1, series=2, protocol=kind + "B")
+			report(kind, "dicomsplit", len(mixedpaths), sum(os.path.getsize(dicompath) for dicompath in mixedpaths), _best_clean(mixedpath,
+				lambda: dicomsplit.split(mixedpath, index=False, jobs=jobs), repeat))
+			if kind == "mosaic":
+				arrs = [pydicom.dcmread(dicompath, stop_before_pixels=True)[0x0029, 0x1010].value for dicompath in dicompaths]
+				report(kind, "csa2", len(arrs), sum(len(arr) for arr in arrs),
+					_best(lambda: [dicomtools.csa2_encode(dicomtools.csa2_decode(arr)) for arr in arrs], repeat))
+			if kind == kinds[-1]:
+				for name, args in _startup_commands(dicompaths[0], niftipath):
+					report("startup", name, 1, 0, _startup(args, repeat))
+	finally:
+		shutil.rmtree(tmppath)
+	if output is not None:
+		with open(output, "a") as fp:
+			fp.write(json.dumps({"commit": commit, "date": datetime.datetime.now().isoformat(), "parameters": parameters, "results": results}) + "\n")
+	return results
+
+
+########
+# main #
+########
+
+def main(argv=None, prog=None):
+	parser = argparse.ArgumentParser(prog=prog, description="Benchmark the conversion paths.")
+	subparsers = parser.add_subparsers(dest="action", help="one of the following actions", metavar="ACTION")
+	subparsers.required = True
+	parser_mosaic = subparsers.add_parser("mosaic", description="Compare mosaic packing and unpacking against the per-slice loops.", help="benchmark mosaic packing and unpacking")
+	parser_mosaic.add_argument("-n", "--nslices", type=int, default=64, help="number of slices per mosaic; default 64")
+	parser_mosaic.add_argument("-s", "--size", type=int, default=64, help="rows and columns of a slice; default 64")
+	parser_mosaic.add_argument("-v", "--nvolumes", type=int, default=100, help="number of mosaics; default 100")
+	parser_mosaic.add_argument("-r", "--repeat", type=int, default=5, help="number of repetitions; default 5")
+	parser_csa2 = subparsers.add_parser("csa2", description="Compare the CSA2 header codec against the byte-by-byte codec.", help="benchmark CSA2 header decoding, encoding and patching")
+	parser_csa2.add_argument("path", nargs="*", help="DICOM files whose CSA headers are also checked", metavar="PATH")
+	parser_csa2.add_argument("-t", "--ntags", type=int, default=100, help="number of tags of the synthetic header; default 100")
+	parser_csa2.add_argument("-r", "--repeat", type=int, default=5, help="number of repetitions; default 5")
+	parser_rle = subparsers.add_parser("rle", description="Compare the RLE Lossless encoder against the pydicom encoder.", help="benchmark RLE Lossless encoding")
+	parser_rle.add_argument("path", nargs="*", help="DICOM files whose frames are checked", metavar="PATH")
+	parser_rle.add_argument("-n", "--nframes", type=int, default=10, help="number of synthetic frames; default 10")
+	parser_rle.add_argument("-s", "--size", type=int, default=256, help="rows and columns of a frame; default 256")
+	parser_rle.add_argument("-r", "--repeat", type=int, default=5, help="number of repetitions; default 5")
+	parser_startup = subparsers.add_parser("startup", description="Measure the cold start of the command lines of cli.py.", help="benchmark the cold start of the command lines")
+	parser_startup.add_argument("-d", "--dicom", help="DICOM file of the dicomtools-dataset command line", metavar="PATH")
+	parser_startup.add_argument("-n", "--nifti", help="NIfTI file of the niftitools-header command line", metavar="PATH")
+	parser_startup.add_argument("-r", "--repeat", type=int, default=5, help="number of repetitions; default 5")
+	parser_suite = subparsers.add_parser("suite", description="Measure the throughput of the conversion paths on synthetic series, and the cold start of the command lines.", help="benchmark dicom2nifti, nifti2dicom, nifti2dicom2, dicomsplit, dicomtable and csa2 on synthetic series, and the cold start of the command lines")
+	parser_suite.add_argument("-k", "--kind", action="append", choices=dicomsynth.KINDS, help="kind of synthetic series, which may be repeated; default all", dest="kinds")
+	parser_suite.add_argument("-n", "--nslices", type=int, default=64, help="number of slices; default 64")
+	parser_suite.add_argument("-s", "--size", type=int, default=256, help="rows and columns of a slice; default 256")
+	parser_suite.add_argument("-v", "--nvolumes", type=int, default=16, help="number of volumes of a mosaic; default 16")
+	parser_suite.add_argument("-r", "--repeat", type=int, default=3, help="number of repetitions; default 3")
+	parser_suite.add_argument("-j", "--jobs", type=int, default=1, help="number of jobs of the conversion paths; default 1")
+	parser_suite.add_argument("-o", "--output", help="JSON lines file the results are appended to, and compared with", metavar="PATH")
+	args = parser.parse_args(argv)
+	if args.action == "csa2":
+		bench_csa2(dicompaths=args.path, ntags=args.ntags, repeat=args.repeat)
+	elif args.action == "mosaic":
+		bench_mosaic(nslices=args.nslices, rows=args.size, columns=args.size, nvolumes=args.nvolumes, repeat=args.repeat)
+	elif args.action == "rle":
+		bench_rle(dicompaths=args.path, nframes=args.nframes, size=args.size, repeat=args.repeat)
+	elif args.action == "startup":
+		bench_startup(dicompath=args.dicom, niftipath=args.nifti, repeat=args.repeat)
+	elif args.action == "suite":
+		bench_suite(kinds=args.kinds or dicomsynth.KINDS, nslices=args.nslices, size=args.size, nvolumes=args.nvolumes, repeat=args.repeat, jobs=args.jobs, output=args.output)
+
+if __name__ == "__main__":
+	main()
@@ -4,13 +4,15 @@ import argparse
 import os
 import re
 
-import pydicom
-
+import lazytools
 import dicomtools
 
-def _path2set(path):
-	if os.path.isdir(path):
-		set = dicomtools.dir_list_files(path)
+numpy = lazytools.lazy_import("numpy")
+pydicom = lazytools.lazy_import("pydicom")
+
+def _path2set(path, index=True, jobs=1):
+	if os.path.isdir(path) or path.endswith(dicomtools.MANIFEST_EXT):
+		set = dicomtools.dir_list_files(path, index=index, jobs=jobs)
 		assert set, "directory {} does not contain any DICOM file".format(path)
 	elif os.path.isfile(path):
 		assert re.search("\.(?:dcm|ima)$", path, flags=re.I), "not a DICOM file {}".format(path)
@@ -19,18 +21,61 @@ def _path2set(path):
 		assert False, "not a valid directory or file {}".format(path)
 	return set
 
-def cmp(set1, set2, verbose=False):
+def _pixel_data(f):
+	if type(f) is bytes:
+		return f
+	if type(f) is pydicom.dataset.FileDataset:
+		return f.PixelData
+	return b"".join(dicomtools.file_get_pixel_data(f))
+
+def _first_difference(f1, f2):
+	# offset of the first differing byte of the pixel data of two DICOM files
+	arr1 = numpy.frombuffer(_pixel_data(f1), numpy.uint8)
+	arr2 = numpy.frombuffer(_pixel_data(f2), numpy.uint8)
+	n = min(len(arr1), len(arr2))
+	offsets = numpy.flatnonzero(arr1[:n] != arr2[:n])
+	return int(offsets[0]) if len(offsets) else n
+
+def cmp_digest(set1, set2, verbose=False, index=True, jobs=1):
+	# compare digests of the pixel data, computed by a pool of jobs threads and cached in the index of each directory
+	assert len(set1) == len(set2), "sets have different number of elements"
+	if verbose:
+		print("comparing {} pairs of DICOM pixel data digests".format(len(set1)))
+	digests = dicomtools.get_digests(list(set1) + list(set2), index=index, jobs=jobs)
+	result = True
+	for i, (f1, f2, d1, d2) in enumerate(zip(set1, set2, digests[:len(set1)], digests[len(set1):])):
+		if d1 == d2:
+			if verbose:
+				print("pair #{}: pass".format(i))
+		else:
+			print("pair #{}: fail at byte {}".format(i, _first_difference(f1, f2)))
+			result = False
+	return result
+
+def _decoded_pixel_data(f):
+	# pixel values, e.g. of compressed pixel data, in native byte order
+	if type(f) is not pydicom.dataset.FileDataset:
+		f = dicomtools.dcmread(f)
+	return f.pixel_array.tobytes()
+
+def cmp(set1, set2, verbose=False, digest=False, index=True, jobs=1, decode=False):
 	if type(set1) is str:
-		set1 = _path2set(set1)
+		set1 = _path2set(set1, index=index, jobs=jobs)
 	if type(set2) is str:
-		set2 = _path2set(set2)
+		set2 = _path2set(set2, index=index, jobs=jobs)
 
 	assert len(set1) == len(set2), "sets have different number of elements"
+	assert not (digest and decode), "can not compare digests of decoded pixel data"
+	if digest:
+		return cmp_digest(set1, set2, verbose=verbose, index=index, jobs=jobs)
 	if verbose:
 		print("comparing {} pairs of DICOM pixel data".format(len(set1)))
 	for i, (f1, f2) in enumerate(zip(set1, set2)):
 		if verbose:
 			print("pair #{}: ".format(i), end="")
+		if decode:
+			f1 = _decoded_pixel_data(f1) if type(f1) is not bytes else f1
+			f2 = _decoded_pixel_data(f2) if type(f2) is not bytes else f2
 		if type(f1) is not bytes:
 			if type(f1) is not pydicom.dataset.FileDataset:
 				f1 = pydicom.dcmread(f1, specific_tags=["PixelData"])
@@ -41,19 +86,23 @@ def cmp(set1, set2, verbose=False):
 			f2 = f2.PixelData
 		cmp = f1 == f2
 		if verbose:
-			print("pass" if cmp else "fail")
+			print("pass" if cmp else "fail at byte {}".format(_first_difference(f1, f2)))
 		if not cmp:
-			if __name__ == "__main__":
-				exit(1)
 			return False
-	if __name__ == "__main__":
-		exit(0)
 	return True
 
-if __name__ == "__main__":
-	parser = argparse.ArgumentParser()
+def main(argv=None, prog=None):
+	parser = argparse.ArgumentParser(prog=prog)
 	parser.add_argument("dir1", help="first directory")
 	parser.add_argument("dir2", help="second directory")
 	parser.add_argument("--verbose", "-v", action="store_true")
-	args = parser.parse_args()
-	cmp(args.dir1, args.dir2, verbose=args.verbose)
+	group = parser.add_mutually_exclusive_group()
+	group.add_argument("-d", "--digest", action="store_true", help="compare cached digests of the pixel data, reporting every differing pair")
+	group.add_argument("--decode", action="store_true", help="compare decoded pixel values, e.g. of compressed and uncompressed DICOM files")
+	parser.add_argument("--no-index", action="store_false", help="do not use the header index of the directories", dest="index")
+	parser.add_argument("-j", "--jobs", type=int, default=1, help="number of threads reading DICOM files; default 1")
+	args = parser.parse_args(argv)
+	exit(0 if cmp(args.dir1, args.dir2, verbose=args.verbose, digest=args.digest, index=args.index, jobs=args.jobs, decode=args.decode) else 1)
+
+if __name__ == "__main__":
+	main()
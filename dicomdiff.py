@@ -4,10 +4,11 @@ import argparse
 import os
 import re
 
-import pydicom
-
+import lazytools
 import dicomtools
 
+pydicom = lazytools.lazy_import("pydicom")
+
 def _path2dataset(path):
 	assert os.path.isfile(path)
 	assert dicomtools.file_is_valid(path)
@@ -47,9 +48,12 @@ def diff(dcm1, dcm2):
 		tag2 = next(tags2, None)
 
 
-if __name__ == "__main__":
-	parser = argparse.ArgumentParser()
+def main(argv=None, prog=None):
+	parser = argparse.ArgumentParser(prog=prog)
 	parser.add_argument("dcm1", help="first DICOM file")
 	parser.add_argument("dcm2", help="second DICOM file")
-	args = parser.parse_args()
+	args = parser.parse_args(argv)
 	diff(args.dcm1, args.dcm2)
+
+if __name__ == "__main__":
+	main()
@@ -2,48 +2,96 @@
 
 import argparse
 import os
+import re
 import shutil
+try:
+	import fcntl
+except ImportError:
+	pass
 
-import pydicom
 
 import dicomtools
+import proftools
 
 def _get_tag(dicom, tags):
 	if type(dicom) is str:
-		dicom = pydicom.dcmread(dicom, specific_tags=tags)
+		dicom = dicomtools.dcmread(dicom, specific_tags=tags)
 	return "-".join(str(dicom[tag].value) for tag in tags)
 
-def split(path, tags=[], move=False, force=False, single=False, verbose=False):
-	assert os.path.isdir(path), "path {} is not a directory".format(path)
+# ioctl cloning the extents of a file on copy-on-write filesystems, e.g. Btrfs and XFS
+_FICLONE = 0x40049409
+
+def _reflink(src, dst):
+	with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+		fcntl.ioctl(fdst.fileno(), _FICLONE, fsrc.fileno())
+	shutil.copystat(src, dst)
+
+def _link(src, dst, link):
+	# place src at dst as a hard link, symbolic link or reflink
+	# fall back to copying, e.g. across filesystems, and return the way actually used
+	try:
+		if link == "hard":
+			os.link(src, dst)
+		elif link == "sym":
+			os.symlink(os.path.relpath(src, os.path.dirname(dst)), dst)
+		elif link == "reflink":
+			_reflink(src, dst)
+		else:
+			assert False, "unknown link {}".format(link)
+		return link
+	except (OSError, NameError):
+		if os.path.lexists(dst):
+			os.remove(dst)
+		shutil.copy2(src, dst)
+		return "copy"
+
+def split(path, tags=[], move=False, force=False, single=False, verbose=False, index=True, link=None, virtual=False, jobs=1, profile=None):
+	# series of an archive are placed next to it, prefixed with the name of the archive, e.g. exam-T1-s001 of exam.zip,
+	# thus the series of archives in the same directory do not collide
+	archive = dicomtools.archive_is_valid(path)
+	assert os.path.isdir(path) or archive, "path {} is neither a directory nor an archive".format(path)
+	assert not (move and archive), "can not move DICOM files out of archive {}".format(path)
+	outpath = os.path.dirname(path) if archive else path
+	prefix = re.sub(dicomtools.ARCHIVE_RE, "", os.path.basename(path), flags=re.I) + "-" if archive else ""
 	# find DICOM files
 	files = []
 	dcmsets = []
-	for filename in os.listdir(path):
-		filepath = os.path.join(path, filename)
-		if not os.path.isfile(filepath):
-			continue
-		try:
+	with proftools.stage(profile, "scan") as counts:
+		headers = dicomtools.dir_scan(path, index=index, jobs=jobs)
+		counts["files"] = len(headers)
+	with proftools.stage(profile, "header", files=len(headers) if tags else 0):
+		for filepath, header in headers:
+			filename = os.path.basename(filepath)
 			if tags:
 				dcmset = _get_tag(filepath, tags)
 			else:
-				dcmset = dicomtools.get_series(filepath)
-		except pydicom.errors.InvalidDicomError:
-			continue
-		files.append((filename, filepath, dcmset))
-		if dcmset not in dcmsets:
-			dcmsets.append(dcmset)
+				dcmset = dicomtools.get_series(header)
+			dcmset = prefix + dcmset
+			files.append((filename, filepath, dcmset))
+			if dcmset not in dcmsets:
+				dcmsets.append(dcmset)
 	if verbose:
 		print("found {} DICOM files with {} different series".format(len(files), len(dcmsets)))
-	if len(dcmsets) > 1 or len(dcmsets) == 1 and single:
+	if virtual and (len(dcmsets) > 1 or len(dcmsets) == 1 and single):
+		# write a manifest per series, leaving DICOM files in place
+		for dcmset in dcmsets:
+			manifestpath = os.path.join(outpath, dcmset + dicomtools.MANIFEST_EXT)
+			assert force or not os.path.exists(manifestpath), "file {} exists".format(manifestpath)
+			if verbose:
+				print("writing manifest {}".format(manifestpath))
+			with proftools.stage(profile, "write", files=1) as counts:
+				dicomtools.manifest_write(manifestpath, [filepath for filename, filepath, fdcmset in files if fdcmset == dcmset])
+				counts["bytes_written"] = os.path.getsize(manifestpath)
+	elif len(dcmsets) > 1 or len(dcmsets) == 1 and single:
 		# check subdirectories
 		if not force:
 			for dcmset in dcmsets:
-				dirpath = os.path.join(path, dcmset)
+				dirpath = os.path.join(outpath, dcmset)
 				assert not os.path.isfile(dirpath), "file {} exists".format(dcmset)
 				assert not os.path.isdir(dirpath), "directory {} exists".format(dcmset)
 		# create subdirectories
 		for dcmset in dcmsets:
-			dirpath = os.path.join(path, dcmset)
+			dirpath = os.path.join(outpath, dcmset)
 			if os.path.isfile(dirpath):
 				if verbose:
 					print("removing file {}".format(dcmset))
@@ -56,27 +104,58 @@ def split(path, tags=[], move=False, force=False, single=False, verbose=False):
 				print("creating directory {}".format(dcmset))
 			os.mkdir(dirpath)
 		# place DICOM files to subdirectories 
-		for i, (filename, filepath, dcmset) in enumerate(files):
-			newpath = os.path.join(path, dcmset, filename)
-			if move:
-				if verbose:
-					print("[{}/{}] moving DICOM file {} to directory {}".format(i + 1, len(files), filename, dcmset))
-				shutil.move(filepath, newpath)
-			else:
-				if verbose:
-					print("[{}/{}] copying DICOM file {} to directory {}".format(i + 1, len(files), filename, dcmset))
-				shutil.copy2(filepath, newpath)
+		# bytes are counted as written only for copies, not for moves and links
+		with proftools.stage(profile, "write", files=len(files)) as counts:
+			for i, (filename, filepath, dcmset) in enumerate(files):
+				newpath = os.path.join(outpath, dcmset, filename)
+				if archive:
+					# extract the member
+					if verbose:
+						print("[{}/{}] extracting DICOM file {} to directory {}".format(i + 1, len(files), filename, dcmset))
+					with dicomtools.file_open(filepath) as fsrc, open(newpath, "wb") as fdst:
+						shutil.copyfileobj(fsrc, fdst)
+						counts["bytes_written"] += fdst.tell()
+				elif move:
+					if verbose:
+						print("[{}/{}] moving DICOM file {} to directory {}".format(i + 1, len(files), filename, dcmset))
+					shutil.move(filepath, newpath)
+				elif link:
+					used = _link(filepath, newpath, link)
+					if verbose:
+						print("[{}/{}] {} DICOM file {} to directory {}".format(i + 1, len(files), "copying" if used == "copy" else "linking", filename, dcmset))
+					if used == "copy":
+						counts["bytes_written"] += os.path.getsize(newpath)
+				else:
+					if verbose:
+						print("[{}/{}] copying DICOM file {} to directory {}".format(i + 1, len(files), filename, dcmset))
+					shutil.copy2(filepath, newpath)
+					counts["bytes_written"] += os.path.getsize(newpath)
 	if verbose:
 		print("dicomsplit complete")
 	return dcmsets
 
-if __name__ == "__main__":
-	parser = argparse.ArgumentParser(description="Place each DICOM file in a subdirectory according to Protocol Name and Series Number.")
-	parser.add_argument("path", help="directory of mixed DICOM files", metavar="PATH")
-	parser.add_argument("-m", "--move", action="store_true", help="move files instead of copying")
+def main(argv=None, prog=None):
+	parser = argparse.ArgumentParser(prog=prog, description="Place each DICOM file in a subdirectory according to Protocol Name and Series Number.")
+	parser.add_argument("path", help="directory or archive of mixed DICOM files", metavar="PATH")
+	group = parser.add_mutually_exclusive_group()
+	group.add_argument("-m", "--move", action="store_true", help="move files instead of copying")
+	group.add_argument("-l", "--link", choices=["hard", "sym", "reflink"], help="link files instead of copying, falling back to copying, e.g. across filesystems")
+	group.add_argument("--virtual", action="store_true", help="write a manifest per series instead of placing files in subdirectories")
 	parser.add_argument("-t", "--tag", action="append", help="split DICOM files according to a custom tag", dest="tags")
 	parser.add_argument("-f", "--force", action="store_true", help="overwrite existing subdirectories")
 	parser.add_argument("-s", "--single", action="store_true", help="run even if all DICOM files belong to the same series")
 	parser.add_argument("-v", "--verbose", action="store_true", help="print actions")
-	args = parser.parse_args()
-	split(args.path, tags=args.tags, move=args.move, force=args.force, single=args.single, verbose=args.verbose)
+	parser.add_argument("--no-index", action="store_false", help="do not use the header index of the directory", dest="index")
+	parser.add_argument("-j", "--jobs", type=int, default=1, help="number of threads reading DICOM headers; default 1")
+	parser.add_argument("--profile", action="store_true", help="print the time, files and bytes of each stage")
+	parser.add_argument("--stats-json", help="save the time, files and bytes of each stage to a JSON file", metavar="PATH")
+	args = parser.parse_args(argv)
+	profile = proftools.new() if args.profile or args.stats_json else None
+	split(args.path, tags=args.tags, move=args.move, force=args.force, single=args.single, verbose=args.verbose, index=args.index, link=args.link, virtual=args.virtual, jobs=args.jobs, profile=profile)
+	if args.profile:
+		proftools.report(profile)
+	if args.stats_json:
+		proftools.save(profile, args.stats_json)
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,273 @@
+#!/usr/bin/python3
+
+import argparse
+import os
+import math
+
+import lazytools
+import dicomtools
+
+numpy = lazytools.lazy_import("numpy")
+pydicom = lazytools.lazy_import("pydicom")
+
+# synthetic MR series, e.g. for benchmarks, written without any scanner or external data
+# the image is a phantom of two ellipsoids with noise, thus compresses like an MR image
+# UIDs are derived from the seed, thus a series is the same on every run
+
+KINDS = ["stack", "mosaic", "ge", "philips"]
+
+def _uid(seed, *args):
+	return pydicom.uid.generate_uid(entropy_srcs=[str(seed)] + [str(arg) for arg in args])
+
+def _phantom(size, nslices, k, random):
+	# slice k of the phantom, as int16 rows x columns
+	y, x = (numpy.mgrid[:size, :size] - (size - 1) / 2) / (size / 2)
+	z = (k - (nslices - 1) / 2) / max(nslices / 2, 1)
+	outer = (x / 0.8) ** 2 + (y / 0.9) ** 2 + (z / 0.95) ** 2 < 1
+	inner = (x / 0.5) ** 2 + (y / 0.6) ** 2 + (z / 0.7) ** 2 < 1
+	arr = numpy.where(inner, 400, numpy.where(outer, 800, 0)) + random.normal(0, 20, (size, size)) * outer + random.normal(0, 3, (size, size))
+	return numpy.clip(arr, 0, 4095).astype(numpy.int16)
+
+def _csa2_image_header_info(nslices, position, time):
+	# items of a Siemens CSA Image Header Info, as read by get_affine and nifti2dicom
+	hdr = {}
+	def item(key, vr, data):
+		hdr[key] = {"VM": len(data), "VR": vr, "SyngoDT": 3, "Data": data}
+	item("EchoLinePosition", "IS", ["64"])
+	item("EchoColumnPosition", "IS", ["64"])
+	item("EchoPartitionPosition", "IS", ["32"])
+	item("UsedChannelMask", "UL", ["4294967295"])
+	item("Actual3DImaPartNumber", "IS", [])
+	item("ICE_Dims", "LO", ["X_1_1_1_1_1_1_1_1_1_1_1_1"])
+	item("B_value", "IS", ["0"])
+	item("Filter1", "IS", ["0"])
+	item("Filter2", "IS", ["0"])
+	item("ProtocolSliceNumber", "IS", ["0"])
+	item("RealDwellTime", "IS", ["2700"])
+	item("PixelFile", "UN", [])
+	item("PixelFileName", "UN", [])
+	item("SliceMeasurementDuration", "DS", ["70000.00000000"])
+	item("SequenceMask", "UL", ["134217728"])
+	item("AcquisitionMatrixText", "SH", ["64*64"])
+	item("MeasuredFourierLines", "IS", ["0"])
+	item("FlowEncodingDirection", "IS", [])
+	item("FlowVenc", "FD", [])
+	item("PhaseEncodingDirectionPositive", "IS", ["1"])
+	item("NumberOfImagesInMosaic", "US", [str(nslices)] if nslices > 1 else [])
+	item("DiffusionGradientDirection", "FD", [])
+	item("ImageGroup", "US", [])
+	item("SliceNormalVector", "FD", ["0.00000000", "0.00000000", "1.00000000"])
+	item("DiffusionDirectionality", "CS", [])
+	item("TimeAfterStart", "DS", ["{:.8f}".format(time)])
+	item("FlipAngle", "DS", [])
+	item("SequenceName", "SH", [])
+	item("RepetitionTime", "DS", [])
+	item("EchoTime", "DS", [])
+	item("NumberOfAverages", "DS", [])
+	item("VoxelThickness", "DS", [])
+	item("VoxelPhaseFOV", "DS", [])
+	item("VoxelReadoutFOV", "DS", [])
+	item("VoxelPositionSag", "DS", [])
+	item("VoxelPositionCor", "DS", [])
+	item("VoxelPositionTra", "DS", [])
+	item("VoxelNormalSag", "DS", [])
+	item("VoxelNormalCor", "DS", [])
+	item("VoxelNormalTra", "DS", [])
+	item("VoxelInPlaneRot", "DS", [])
+	item("ImagePositionPatient", "DS", [])
+	item("ImageOrientationPatient", "DS", [])
+	item("PixelSpacing", "DS", [])
+	item("SliceLocation", "DS", [])
+	item("SliceThickness", "DS", [])
+	item("SpectrumTextRegionLabel", "SH", [])
+	item("Comp_Algorithm", "IS", [])
+	item("Comp_Blended", "IS", [])
+	item("Comp_ManualAdjusted", "IS", [])
+	item("Comp_AutoParam", "LT", [])
+	item("Comp_AdjustedParam", "LT", [])
+	item("Comp_JobID", "LT", [])
+	item("FMRIStimulInfo", "IS", [])
+	item("FlowEncodingDirectionString", "SH", [])
+	item("RepetitionTimeEffective", "DS", [])
+	item("CsiImagePositionPatient", "DS", [])
+	item("CsiImageOrientationPatient", "DS", [])
+	item("CsiPixelSpacing", "DS", [])
+	item("CsiSliceLocation", "DS", [])
+	item("CsiSliceThickness", "DS", [])
+	item("OriginalSeriesNumber", "IS", [])
+	item("OriginalImageNumber", "IS", [])
+	item("ImaAbsTablePosition", "SL", ["0", "0", "-1200"])
+	item("NonPlanarImage", "US", ["0"])
+	item("MoCoQMeasure", "US", [])
+	item("LQAlgorithm", "SH", [])
+	item("SlicePosition_PCS", "FD", ["{:.8f}".format(x) for x in position])
+	item("RBMoCoTrans", "FD", [])
+	item("RBMoCoRot", "FD", [])
+	item("MultistepIndex", "IS", [])
+	item("ImaRelTablePosition", "IS", ["0", "0", "0"])
+	item("ImaCoilString", "LO", ["HEA;HEP"])
+	item("RFSWDDataType", "SH", ["predicted"])
+	item("GSWDDataType", "SH", ["predicted"])
+	item("NormalizeManipulated", "IS", [])
+	item("ImaPATModeText", "LO", ["p2"])
+	item("B_matrix", "FD", [])
+	item("BandwidthPerPixelPhaseEncode", "FD", ["25.00000000"])
+	item("FMRIStimulLevel", "FD", [])
+	item("MosaicRefAcqTimes", "FD", ["{:.8f}".format(2000 * s / nslices) for s in range(nslices)] if nslices > 1 else [])
+	item("AutoInlineImageFilterEnabled", "SL", [])
+	item("QCData", "FD", [])
+	item("ExamLandmarks", "LT", [])
+	item("ExamDataRole", "ST", [])
+	item("MRDiffusion", "ST", [])
+	item("RealWorldValueMapping", "ST", [])
+	item("DataSetInfo", "ST", [])
+	item("UsedChannelString", "UT", ["XXXXXXXXXXXXXXXXXXXX"])
+	item("PACEFeedbackUsed", "LO", [])
+	return hdr
+
+def synth_series(kind="stack", nslices=32, size=256, nvolumes=1, seed=0, series=1, protocol=None, implicit=False):
+	# yield (filename, dataset) of each DICOM file of a synthetic series
+	# a stack has a file per slice, a mosaic has a file per volume of nslices tiles
+	assert kind in KINDS, "unknown kind {}".format(kind)
+	random = numpy.random.RandomState(seed)
+	protocol = protocol or kind
+	nfiles = nvolumes if kind == "mosaic" else nslices
+	nblocks = math.ceil(math.sqrt(nslices))
+	spacing = [1.0, 1.0]
+	thickness = 3.0
+	repetition_time = 2000.0
+	series_instance_uid = _uid(seed, kind, series)
+	corner = [-size * spacing[1] / 2, -size * spacing[0] / 2, -nslices * thickness / 2]
+	if kind == "mosaic":
+		# cached slices of the phantom, with new noise per volume
+		volume = numpy.stack([_phantom(size, nslices, k, random) for k in range(nslices)])
+	for f in range(nfiles):
+		file_meta = pydicom.dataset.FileMetaDataset()
+		file_meta.MediaStorageSOPClassUID = pydicom.uid.MRImageStorage
+		file_meta.MediaStorageSOPInstanceUID = _uid(seed, kind, series, f)
+		file_meta.TransferSyntaxUID = pydicom.uid.ImplicitVRLittleEndian if implicit else pydicom.uid.ExplicitVRLittleEndian
+		dataset = pydicom.dataset.FileDataset(None, {}, file_meta=file_meta, preamble=bytes(128))
+		dataset.is_little_endian = True
+		dataset.is_implicit_VR = implicit
+		seconds = f * (repetition_time / 1000 if kind == "mosaic" else 1)
+		time = "{:02d}{:02d}{:02d}.{:06d}".format(12 + int(seconds) // 3600, int(seconds) // 60 % 60, int(seconds) % 60, int(seconds % 1 * 1e6))
+		dataset.SpecificCharacterSet = "ISO_IR 100"
+		dataset.ImageType = ["ORIGINAL", "PRIMARY", "M", "ND"] + (["MOSAIC"] if kind == "mosaic" else [])
+		dataset.InstanceCreationDate = "20200101"
+		dataset.InstanceCreationTime = time
+		dataset.SOPClassUID = file_meta.MediaStorageSOPClassUID
+		dataset.SOPInstanceUID = file_meta.MediaStorageSOPInstanceUID
+		dataset.StudyDate = dataset.SeriesDate = dataset.AcquisitionDate = dataset.ContentDate = "20200101"
+		dataset.StudyTime = dataset.SeriesTime = "120000.000000"
+		dataset.AcquisitionTime = dataset.ContentTime = time
+		dataset.Modality = "MR"
+		dataset.Manufacturer = {"stack": "SYNTHETIC", "mosaic": "SIEMENS", "ge": "GE MEDICAL SYSTEMS", "philips": "Philips Medical Systems"}[kind]
+		dataset.SeriesDescription = protocol
+		dataset.PatientName = "Synthetic^Phantom"
+		dataset.PatientID = "SYNTH{:04d}".format(seed)
+		dataset.ScanningSequence = "EP" if kind == "mosaic" else "GR"
+		dataset.SliceThickness = thickness
+		dataset.RepetitionTime = repetition_time
+		dataset.EchoTime = 30.0
+		dataset.SpacingBetweenSlices = thickness
+		dataset.ProtocolName = protocol
+		dataset.InPlanePhaseEncodingDirection = "COL"
+		dataset.StudyInstanceUID = _uid(seed, "study")
+		dataset.SeriesInstanceUID = series_instance_uid
+		dataset.SeriesNumber = series
+		dataset.AcquisitionNumber = f + 1 if kind == "mosaic" else 1
+		dataset.InstanceNumber = f + 1
+		position = corner if kind == "mosaic" else corner[:2] + [corner[2] + f * thickness]
+		dataset.ImagePositionPatient = position
+		dataset.ImageOrientationPatient = [1, 0, 0, 0, 1, 0]
+		dataset.FrameOfReferenceUID = _uid(seed, "frame")
+		dataset.SliceLocation = position[2]
+		dataset.SamplesPerPixel = 1
+		dataset.PhotometricInterpretation = "MONOCHROME2"
+		dataset.Rows = size * nblocks if kind == "mosaic" else size
+		dataset.Columns = size * nblocks if kind == "mosaic" else size
+		dataset.PixelSpacing = spacing
+		dataset.BitsAllocated = 16
+		dataset.BitsStored = 12
+		dataset.HighBit = 11
+		dataset.PixelRepresentation = 1
+		dataset.add_new((0x0028, 0x0106), "SS", 0)
+		dataset.add_new((0x0028, 0x0107), "SS", 0)
+		dataset.WindowCenter = 600
+		dataset.WindowWidth = 1200
+		if kind == "mosaic":
+			# http://nipy.org/nibabel/dicom/siemens_csa.html
+			data = dicomtools.mosaic_tile(volume + random.normal(0, 5, volume.shape).astype(numpy.int16), dataset.Rows, dataset.Columns)
+			dataset.add_new((0x0019, 0x0010), "LO", "SIEMENS MR HEADER")
+			dataset.add_new((0x0019, 0x100a), "US", nslices) # NumberOfImagesInMosaic
+			dataset.add_new((0x0019, 0x100b), "DS", "70000") # SliceMeasurementDuration
+			dataset.add_new((0x0019, 0x1015), "FD", position) # SlicePosition_PCS
+			dataset.add_new((0x0019, 0x1016), "DS", "{:.4f}".format(seconds)) # TimeAfterStart
+			dataset.add_new((0x0019, 0x1029), "FD", [2000 * s / nslices for s in range(nslices)]) # MosaicRefAcqTimes
+			dataset.add_new((0x0029, 0x0010), "LO", "SIEMENS CSA HEADER")
+			dataset.add_new((0x0029, 0x1008), "CS", "IMAGE NUM 4")
+			dataset.add_new((0x0029, 0x1010), "OB", dicomtools.csa2_encode(_csa2_image_header_info(nslices, position, seconds)))
+			dataset.add_new((0x0051, 0x0010), "LO", "SIEMENS MR HEADER")
+			dataset.add_new((0x0051, 0x100d), "SH", "SP A116.1")
+		else:
+			data = _phantom(size, nslices, f, random)
+		if kind == "ge":
+			dataset.add_new((0x0009, 0x0010), "LO", "GEMS_IDEN_01")
+			dataset.add_new((0x0009, 0x1001), "LO", "GE_GENESIS_FF")
+			dataset.add_new((0x0019, 0x0010), "LO", "GEMS_ACQU_01")
+			dataset.add_new((0x0019, 0x10a2), "OB", (1000 + f).to_bytes(4, "little")) # Raw data run number
+			dataset.add_new((0x0021, 0x0010), "LO", "GEMS_RELA_01")
+			dataset.add_new((0x0021, 0x1036), "SS", 0)
+			dataset.add_new((0x0027, 0x0010), "LO", "GEMS_IMAG_01")
+			dataset.add_new((0x0027, 0x1040), "SH", "S" if position[2] >= 0 else "I")
+			dataset.add_new((0x0027, 0x1041), "FL", position[2])
+			dataset.add_new((0x0043, 0x0010), "LO", "GEMS_PARM_01")
+			dataset.add_new((0x0043, 0x1028), "OB", random.bytes(16)) # Unique image iden
+			dataset.add_new((0x0043, 0x1029), "OB", random.bytes(2048)) # Histogram tables
+			dataset.add_new((0x0043, 0x102a), "OB", random.bytes(512)) # User defined data
+			dataset.add_new((0x0043, 0x1030), "SS", 4) # Vas collapse flag
+			dataset.add_new((0x0043, 0x1039), "IS", [0, 0, 0, 0]) # Slop_int_6... slop_int_9
+		elif kind == "philips":
+			dataset.add_new((0x2001, 0x0010), "LO", "Philips Imaging DD 001")
+			dataset.add_new((0x2001, 0x0090), "LO", "Philips Imaging DD 129")
+			dataset.add_new((0x2001, 0x100a), "IS", f + 1) # Slice Number MR
+			dataset.add_new((0x2001, 0x1018), "SL", nslices) # Number of Slices MR
+			dataset.add_new((0x2001, 0x9000), "OB", random.bytes(1024))
+			dataset.add_new((0x2005, 0x0010), "LO", "Philips MR Imaging DD 001")
+			dataset.add_new((0x2005, 0x1008), "FL", position[0])
+			dataset.add_new((0x2005, 0x1009), "FL", position[1])
+			dataset.add_new((0x2005, 0x100a), "FL", position[2])
+		dataset[0x0028, 0x0106].value = int(data.min())
+		dataset[0x0028, 0x0107].value = int(data.max())
+		dataset.PixelData = data.tobytes()
+		dataset[0x7fe0, 0x0010].VR = "OW"
+		yield "{}{:04d}.dcm".format(protocol, f + 1), dataset
+
+def synth(path, kind="stack", nslices=32, size=256, nvolumes=1, seed=0, series=1, protocol=None, implicit=False):
+	# write a synthetic series to a directory, and return the paths of the DICOM files
+	os.makedirs(path, exist_ok=True)
+	dicompaths = []
+	for filename, dataset in synth_series(kind, nslices=nslices, size=size, nvolumes=nvolumes, seed=seed, series=series, protocol=protocol, implicit=implicit):
+		dicompath = os.path.join(path, filename)
+		assert not os.path.exists(dicompath), "file {} exists".format(dicompath)
+		dataset.save_as(dicompath, write_like_original=False)
+		dicompaths.append(dicompath)
+	return dicompaths
+
+def main(argv=None, prog=None):
+	parser = argparse.ArgumentParser(prog=prog, description="Write a synthetic MR series of DICOM files.")
+	parser.add_argument("path", help="output directory", metavar="PATH")
+	parser.add_argument("-k", "--kind", choices=KINDS, default="stack", help="stack of slices without private tags, Siemens mosaic with CSA header, or stack with GE or Philips private tags; default stack")
+	parser.add_argument("-n", "--nslices", type=int, default=32, help="number of slices; default 32")
+	parser.add_argument("-s", "--size", type=int, default=256, help="rows and columns of a slice; default 256")
+	parser.add_argument("-v", "--nvolumes", type=int, default=1, help="number of volumes of a mosaic; default 1")
+	parser.add_argument("--seed", type=int, default=0, help="seed of the phantom noise and the UIDs; default 0")
+	parser.add_argument("--series", type=int, default=1, help="Series Number; default 1")
+	parser.add_argument("-p", "--protocol", help="Protocol Name; default the kind")
+	parser.add_argument("--implicit", action="store_true", help="write implicit VR little endian DICOM files")
+	args = parser.parse_args(argv)
+	dicompaths = synth(args.path, args.kind, nslices=args.nslices, size=args.size, nvolumes=args.nvolumes, seed=args.seed, series=args.series, protocol=args.protocol, implicit=args.implicit)
+	print("wrote {} DICOM files to {}".format(len(dicompaths), args.path))
+
+if __name__ == "__main__":
+	main()
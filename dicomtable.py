@@ -3,71 +3,98 @@
 import argparse
 import os
 import re
+import sys
+import csv
+import json
 
-import pydicom
-
+import lazytools
 import dicomtools
 
-parser = argparse.ArgumentParser(description="Output a table with the variable fields of a DICOM set as a CSV.")
-parser.add_argument("path", help="directory of DICOM files", metavar="PATH")
-args = parser.parse_args()
-
-assert os.path.isdir(args.path)
-
-dicompaths = dicomtools.dir_list_files(args.path)
-
-datasets = [pydicom.dcmread(dicompath, stop_before_pixels=True) for dicompath in dicompaths]
-
-tags = set().union(*[dataset.keys() for dataset in datasets])
-
-vartags = set()
-
-for tag in tags:
-	value = None
-	for i, dataset in enumerate(datasets):
-		if i == 0:
-			if tag in dataset:
-				value = str(dataset[tag].value)
-		else:
-			if tag in dataset and str(dataset[tag].value) == value or tag not in dataset and value is None:
-				pass
-			else:
-				vartags.add(tag)
-
-tags = list(vartags)
-
-tags.sort()
-
-properties = ["VR", "VM", "name", None, "keyword"]
-
-print("id", end="\t")
-print("\t".join([str(tag) for tag in tags]))
-
-print("is_private", end="\t")
-print("\t".join([str(tag.is_private) for tag in tags]))
-
-dataset = datasets[0]
-for i, property in enumerate(properties):
-	if property is not None:
-		print(property, end="")
+pydicom = lazytools.lazy_import("pydicom")
+
+# properties of pydicom.datadict.get_entry
+_properties = ["VR", "VM", "name", None, "keyword"]
+
+def _value(dataset, tag):
+	if tag not in dataset:
+		return None
+	value = re.sub("\s+", " ", str(dataset[tag].value))
+	return value if len(value) < 256 else "?"
+
+def _vartags(dicompaths):
+	# first pass: keep only a fingerprint of the value of each tag in the first DICOM file
+	# a tag varies if its value differs from the fingerprint, or if it is missing from some DICOM file
+	fingerprints = {}
+	vartags = set()
+	# private creator of each private tag, as found in the first DICOM file holding the tag
+	creators = {}
+	for i, dicompath in enumerate(dicompaths):
+		dataset = dicomtools.dcmread(dicompath, stop_before_pixels=True)
+		tags = dataset.keys()
 		for tag in tags:
-			if tag.is_private:
+			if tag in vartags:
+				continue
+			if tag.is_private and tag not in creators and (tag.group, tag.element >> 8) in dataset:
 				# http://dicom.nema.org/dicom/2013/output/chtml/part05/sect_7.8.html
-				private_creator = dataset[tag.group, tag.element >> 8].value
-				if property != "keyword":
-					print("\t{}".format(pydicom.datadict.get_private_entry(tag, private_creator)[i]), end="")
-				else:
-					print("\t", end="")
-			else:
-				print("\t{}".format(pydicom.datadict.get_entry(tag)[i]), end="")
-		print()
-
-for i, dataset in enumerate(datasets):
-	print(i, end="")
-	for tag in tags:
-		if tag in dataset:
-			value = re.sub("\s+", " ", str(dataset[tag].value))
-			print("\t{}".format(value if len(value) < 256 else "?"), end="")
+				creators[tag] = dataset[tag.group, tag.element >> 8].value
+			fingerprint = hash(str(dataset[tag].value))
+			if i == 0:
+				fingerprints[tag] = fingerprint
+			elif fingerprints.get(tag) != fingerprint:
+				vartags.add(tag)
+		vartags.update(tag for tag in fingerprints.keys() - tags)
+	return sorted(vartags), creators
+
+def _property(tag, i, creators):
+	if tag.is_private:
+		if _properties[i] == "keyword":
+			return ""
+		return str(pydicom.datadict.get_private_entry(tag, creators[tag])[i])
+	return str(pydicom.datadict.get_entry(tag)[i])
+
+def table(path, fp=None, format="tsv", index=True, jobs=1):
+	# output a table with the variable fields of a set of DICOM files
+	# the DICOM files are read twice, thus memory does not depend on the number of DICOM files
+	if fp is None:
+		fp = sys.stdout
+	dicompaths = dicomtools.dir_list_files(path, index=index, jobs=jobs)
+	tags, creators = _vartags(dicompaths)
+	if format == "jsonl":
+		def writerow(row):
+			fp.write(json.dumps(row) + "\n")
+	elif format == "csv":
+		writerow = csv.writer(fp).writerow
+	else:
+		def writerow(row):
+			fp.write("\t".join(row) + "\n")
+	# header rows
+	if format == "jsonl":
+		keys = [str(tag) for tag in tags]
+	else:
+		writerow(["id"] + [str(tag) for tag in tags])
+		writerow(["is_private"] + [str(tag.is_private) for tag in tags])
+		for i, property in enumerate(_properties):
+			if property is not None:
+				writerow([property] + [_property(tag, i, creators) for tag in tags])
+	# second pass: a row per DICOM file
+	for i, dicompath in enumerate(dicompaths):
+		dataset = dicomtools.dcmread(dicompath, stop_before_pixels=True)
+		values = [_value(dataset, tag) for tag in tags]
+		if format == "jsonl":
+			writerow(dict([("id", i)] + list(zip(keys, values))))
 		else:
-			print("\t", end="")
-	print()
+			writerow([str(i)] + [value if value is not None else "" for value in values])
+	return tags
+
+def main(argv=None, prog=None):
+	parser = argparse.ArgumentParser(prog=prog, description="Output a table with the variable fields of a DICOM set.")
+	parser.add_argument("path", help="directory of DICOM files or manifest of a series", metavar="PATH")
+	parser.add_argument("-f", "--format", choices=["tsv", "csv", "jsonl"], default="tsv", help="output format; default tsv")
+	parser.add_argument("--no-index", action="store_false", help="do not use the header index of the directory", dest="index")
+	parser.add_argument("-j", "--jobs", type=int, default=1, help="number of threads reading DICOM headers; default 1")
+	args = parser.parse_args(argv)
+	assert os.path.exists(args.path), "{} does not exist".format(args.path)
+	table(args.path, format=args.format, index=args.index, jobs=args.jobs)
+
+if __name__ == "__main__":
+	main()
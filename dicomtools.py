@@ -5,10 +5,25 @@ import os
 import re
 import math
 import datetime
-from collections import OrderedDict
+import copy
+import contextlib
+import json
+import struct
+import hashlib
+import io
+import threading
+from collections import OrderedDict, deque
+import concurrent.futures
+from concurrent.futures import ThreadPoolExecutor
 
-import numpy
-import pydicom
+import lazytools
+import niftitools
+
+numpy = lazytools.lazy_import("numpy")
+pydicom = lazytools.lazy_import("pydicom")
+sqlite3 = lazytools.lazy_import("sqlite3")
+zipfile = lazytools.lazy_import("zipfile")
+tarfile = lazytools.lazy_import("tarfile")
 try:
 	import unidecode
 except ImportError:
@@ -28,10 +43,62 @@ def file_get_tag(filename, tag):
 	except pydicom.errors.InvalidDicomError:
 		return None
 
-def dir_list_files(path="."):
-	fs = [os.path.join(path, f) for f in os.listdir(path)]
-	fs = [f for f in fs if os.path.isfile(f)]
-	fs = [(f, file_get_tag(f, "InstanceNumber")) for f in fs]
+def file_get_header(filename):
+	try:
+		with file_open(filename) as fp:
+			dataset = pydicom.dcmread(fp, stop_before_pixels=True, specific_tags=INDEX_TAGS)
+			header = {tag: _index_value(dataset.data_element(tag).value) for tag in INDEX_TAGS if tag in dataset}
+			header["PixelDataOffset"], header["PixelDataLength"] = _pixel_data_offset(fp, dataset)
+	except (pydicom.errors.InvalidDicomError, EOFError, OSError, ValueError):
+		# e.g. not a DICOM file, or a DICOM file still being written
+		return None
+	return header
+
+def _scan_entry(entry, row):
+	# header of a directory entry, from the cached row of the index if it is still valid
+	stat = entry.stat()
+	if row is not None and row[0] == stat.st_size and row[1] == stat.st_mtime_ns:
+		return json.loads(row[2]), None
+	header = file_get_header(entry.path)
+	return header, (entry.name, stat.st_size, stat.st_mtime_ns, json.dumps(header))
+
+def dir_scan(path=".", index=True, jobs=1):
+	# headers are read by a pool of jobs threads, since scanning is bound by the latency of the storage
+	if archive_is_valid(path):
+		return archive_scan(path, jobs=jobs)
+	if os.path.isfile(path):
+		return manifest_scan(path, index=index, jobs=jobs)
+	with os.scandir(path) as it:
+		entries = [entry for entry in it if entry.name != INDEX_FILENAME and entry.is_file()]
+	entries.sort(key=lambda entry: entry.name)
+	connection = _index_connect(path) if index else None
+	cached = {}
+	if connection is not None:
+		cached = {row[0]: row[1:] for row in connection.execute("SELECT name, size, mtime, header FROM headers")}
+	rows = [cached.get(entry.name) for entry in entries]
+	if jobs > 1:
+		with ThreadPoolExecutor(jobs) as executor:
+			results = list(executor.map(_scan_entry, entries, rows))
+	else:
+		results = list(map(_scan_entry, entries, rows))
+	files = []
+	updates = []
+	for entry, (header, update) in zip(entries, results):
+		if update is not None:
+			updates.append(update)
+		if header is not None:
+			files.append((os.path.join(path, entry.name), header))
+	if connection is not None:
+		stale = set(cached).difference(entry.name for entry in entries)
+		with connection:
+			connection.executemany("INSERT OR REPLACE INTO headers VALUES (?, ?, ?, ?)", updates)
+			connection.executemany("DELETE FROM headers WHERE name = ?", [(name,) for name in stale])
+			connection.executemany("DELETE FROM digests WHERE name = ?", [(name,) for name in stale])
+		connection.close()
+	return files
+
+def dir_list_files(path=".", index=True, jobs=1):
+	fs = [(f, header.get("InstanceNumber")) for f, header in dir_scan(path, index=index, jobs=jobs)]
 	fs = [f for f in fs if f[1] is not None]
 	fs.sort(key=lambda f: f[1])
 	return [f[0] for f in fs]
@@ -39,7 +106,10 @@ def dir_list_files(path="."):
 def get_series(dicom):
 	if type(dicom) is str:
 		dicom = pydicom.dcmread(dicom, specific_tags=["SeriesNumber", "ProtocolName"])
-	series = "{}-s{:03d}".format(dicom.ProtocolName, dicom.SeriesNumber)
+	if type(dicom) is dict:
+		series = "{}-s{:03d}".format(dicom["ProtocolName"], dicom["SeriesNumber"])
+	else:
+		series = "{}-s{:03d}".format(dicom.ProtocolName, dicom.SeriesNumber)
 	try:
 		series = unidecode.unidecode(series)
 	except NameError:
@@ -50,7 +120,7 @@ def get_affine(dataset1, dataset2):
 	# number of slices
 	nslices = 1
 	if (0x0029, 0x0010) in dataset1 and dataset1[0x0029, 0x0010].value == "SIEMENS CSA HEADER":
-		csa_image_header_info = csa2_decode(dataset1[0x0029, 0x1010].value)
+		csa_image_header_info = csa2_decode(dataset1[0x0029, 0x1010].value, keys=["NumberOfImagesInMosaic", "SliceNormalVector"])
 		if csa_image_header_info["NumberOfImagesInMosaic"]["Data"]:
 			nslices = int(csa_image_header_info["NumberOfImagesInMosaic"]["Data"][0])
 	# shape, zooms & affine
@@ -92,64 +162,411 @@ def get_affine(dataset1, dataset2):
 	return shape, zooms, affine
 
 
+#########
+# index #
+#########
+
+# persistent header index of a directory, keyed by file name, size and mtime
+# a file is parsed again only if it is new or changed since the last scan
+
+INDEX_FILENAME = ".dicomindex.sqlite"
+
+# bump INDEX_VERSION whenever INDEX_TAGS or the header format change
+INDEX_VERSION = 2
+
+INDEX_TAGS = [
+	"InstanceNumber", "SeriesNumber", "ProtocolName",
+	"Rows", "Columns", "PixelSpacing", "ImageOrientationPatient", "ImagePositionPatient",
+	"SliceThickness", "SpacingBetweenSlices", "RepetitionTime",
+	"BitsAllocated", "PixelRepresentation", "SamplesPerPixel",
+]
+
+def _index_connect(path):
+	try:
+		connection = sqlite3.connect(os.path.join(path, INDEX_FILENAME))
+		if connection.execute("PRAGMA user_version").fetchone()[0] != INDEX_VERSION:
+			connection.execute("DROP TABLE IF EXISTS headers")
+			connection.execute("DROP TABLE IF EXISTS digests")
+			connection.execute("PRAGMA user_version = {}".format(INDEX_VERSION))
+		connection.execute("CREATE TABLE IF NOT EXISTS headers (name TEXT PRIMARY KEY, size INTEGER, mtime INTEGER, header TEXT)")
+		connection.execute("CREATE TABLE IF NOT EXISTS digests (name TEXT PRIMARY KEY, size INTEGER, mtime INTEGER, digest TEXT)")
+	except sqlite3.Error:
+		# e.g. read-only directory
+		return None
+	return connection
+
+def _index_value(value):
+	# empty values are kept as None, e.g. an empty Instance Number, rather than the string None
+	if value is None:
+		return None
+	if isinstance(value, (list, pydicom.multival.MultiValue)):
+		return [_index_value(v) for v in value]
+	if isinstance(value, int):
+		return int(value)
+	if isinstance(value, float):
+		return float(value)
+	return str(value)
+
+def _pixel_data_offset(fp, dataset):
+	# offset and length of the Pixel Data (0x7fe0, 0x0010) value; native little endian transfer syntaxes only
+	# expects fp right after pydicom.dcmread(fp, stop_before_pixels=True)
+	transfer_syntax = dataset.file_meta.get("TransferSyntaxUID")
+	if transfer_syntax == pydicom.uid.ImplicitVRLittleEndian:
+		header_len = 8
+	elif transfer_syntax == pydicom.uid.ExplicitVRLittleEndian:
+		header_len = 12
+	else:
+		return None, None
+	offset = fp.tell()
+	arr = fp.read(header_len)
+	if len(arr) < header_len or struct.unpack_from("<HH", arr) != (0x7fe0, 0x0010):
+		return None, None
+	length = struct.unpack_from("<L", arr, header_len - 4)[0]
+	if length == 0xffffffff:
+		# undefined length, i.e. encapsulated
+		return None, None
+	return offset + header_len, length
+
+
+##########
+# digest #
+##########
+
+# digest of the Pixel Data (0x7fe0, 0x0010) value of a DICOM file
+# the value is streamed from its offset in the file, as found by file_get_header
+# digests are cached in the index of the directory of each file, keyed by name, size and mtime
+
+DIGEST_CHUNK = 1 << 20
+
+def file_get_pixel_data(filename, header=None, chunk=DIGEST_CHUNK):
+	# yield the Pixel Data value of a DICOM file in chunks
+	if header is None:
+		header = file_get_header(filename)
+	if header is not None and header.get("PixelDataOffset") is not None:
+		with file_open(filename) as fp:
+			fp.seek(header["PixelDataOffset"])
+			length = header["PixelDataLength"]
+			while length > 0:
+				arr = fp.read(min(chunk, length))
+				if not arr:
+					break
+				length -= len(arr)
+				yield arr
+	else:
+		# e.g. encapsulated pixel data
+		dataset = dcmread(filename, specific_tags=["PixelData"])
+		if "PixelData" in dataset:
+			yield dataset.PixelData
+
+def file_get_digest(filename, header=None):
+	digest = hashlib.blake2b()
+	for arr in file_get_pixel_data(filename, header):
+		digest.update(arr)
+	return digest.hexdigest()
+
+def get_digests(filepaths, index=True, jobs=1):
+	# digests of the pixel data of DICOM files, computed by a pool of jobs threads
+	digests = [None] * len(filepaths)
+	stats = [os.stat(filepath) for filepath in filepaths]
+	# look up the index of each directory
+	connections = {}
+	if index:
+		for dirpath in set(os.path.dirname(filepath) for filepath in filepaths):
+			connections[dirpath] = _index_connect(dirpath or ".")
+		for i, (filepath, stat) in enumerate(zip(filepaths, stats)):
+			connection = connections[os.path.dirname(filepath)]
+			if connection is not None:
+				row = connection.execute("SELECT size, mtime, digest FROM digests WHERE name = ?", (os.path.basename(filepath),)).fetchone()
+				if row is not None and row[0] == stat.st_size and row[1] == stat.st_mtime_ns:
+					digests[i] = row[2]
+	# compute missing digests
+	missing = [i for i, digest in enumerate(digests) if digest is None]
+	if jobs > 1:
+		with ThreadPoolExecutor(jobs) as executor:
+			results = list(executor.map(file_get_digest, [filepaths[i] for i in missing]))
+	else:
+		results = [file_get_digest(filepaths[i]) for i in missing]
+	for i, digest in zip(missing, results):
+		digests[i] = digest
+	# update indices
+	for dirpath, connection in connections.items():
+		if connection is not None:
+			with connection:
+				connection.executemany("INSERT OR REPLACE INTO digests VALUES (?, ?, ?, ?)", [
+					(os.path.basename(filepaths[i]), stats[i].st_size, stats[i].st_mtime_ns, digests[i])
+					for i in missing if os.path.dirname(filepaths[i]) == dirpath
+				])
+			connection.close()
+	return digests
+
+
+#########
+# pixel #
+#########
+
+# native little endian pixel data is read straight into the destination array, e.g. a slice of a volume
+# other pixel data, e.g. encapsulated, is decoded by pydicom
+
+# tags needed to decode the pixel data of a DICOM file
+_pixel_tags = [
+	"BitsAllocated", "BitsStored", "Rows", "Columns", "PhotometricInterpretation", "PixelRepresentation", "SamplesPerPixel", "NumberOfFrames", "PixelData"
+]
+
+def get_dtype(dataset):
+	# numpy dtype of the pixel data, as by pydicom, e.g. "<i2" for BitsAllocated 16 and PixelRepresentation 1
+	assert dataset.BitsAllocated in [8, 16, 32], "unsupported Bits Allocated {}".format(dataset.BitsAllocated)
+	return numpy.dtype("<{}{}".format("i" if dataset.PixelRepresentation else "u", dataset.BitsAllocated // 8))
+
+def file_read_pixel_array(filename, out=None):
+	# pixel array of a single frame DICOM file, as dataset.pixel_array
+	# in case out is a C-contiguous array of the same shape and dtype, the pixel data is read into it
+	with file_open(filename) as fp:
+		dataset = pydicom.dcmread(fp, stop_before_pixels=True, specific_tags=_pixel_tags)
+		offset, length = _pixel_data_offset(fp, dataset)
+		if offset is not None and dataset.get("SamplesPerPixel", 1) == 1 and int(dataset.get("NumberOfFrames") or 1) == 1 and dataset.BitsAllocated in [8, 16, 32]:
+			shape = (dataset.Rows, dataset.Columns)
+			dtype = get_dtype(dataset)
+			if out is None:
+				arr = numpy.empty(shape, dtype)
+			elif out.shape == shape and out.dtype == dtype and out.flags.c_contiguous:
+				arr = out
+			else:
+				arr = None
+			# excess padding is skipped as by pydicom
+			if arr is not None and length >= arr.nbytes:
+				n = fp.readinto(memoryview(arr).cast("B"))
+				assert n == arr.nbytes, "truncated pixel data in {}".format(filename)
+				return arr
+	arr = dcmread(filename, specific_tags=_pixel_tags).pixel_array
+	if out is None:
+		return arr
+	out[...] = arr
+	return out
+
+
+###########
+# archive #
+###########
+
+# members of zip and tar archives are addressed as ARCHIVE/MEMBER, e.g. exam.zip/DICOM/IM0001
+# they are read as streams, thus archives need not be extracted
+# the headers of archive members are not cached, since no index can be written in an archive
+
+ARCHIVE_RE = "\.(?:zip|tar|tar\.gz|tgz|tar\.bz2|tbz2|tar\.xz|txz)$"
+
+# open archives, keyed by process, path and mtime, since forked processes must not share file offsets
+_archives = {}
+_archives_lock = threading.Lock()
+
+def archive_is_valid(path):
+	return re.search(ARCHIVE_RE, path, flags=re.I) is not None and os.path.isfile(path)
+
+def archive_split(path):
+	# archive path and member name of ARCHIVE/MEMBER, or None
+	parts = path.split(os.sep)
+	for i in range(1, len(parts)):
+		archivepath = os.sep.join(parts[:i])
+		if archive_is_valid(archivepath):
+			return archivepath, "/".join(parts[i:])
+	return None
+
+def _archive_open(archivepath):
+	key = (os.getpid(), archivepath, os.stat(archivepath).st_mtime_ns)
+	with _archives_lock:
+		if key not in _archives:
+			if zipfile.is_zipfile(archivepath):
+				_archives[key] = (zipfile.ZipFile(archivepath), threading.Lock())
+			else:
+				_archives[key] = (tarfile.open(archivepath), threading.Lock())
+		return _archives[key]
+
+def archive_list(archivepath):
+	# names of the file members of an archive, sorted
+	archive, lock = _archive_open(archivepath)
+	with lock:
+		if type(archive) is zipfile.ZipFile:
+			return sorted(info.filename for info in archive.infolist() if not info.is_dir())
+		return sorted(info.name for info in archive.getmembers() if info.isfile())
+
+def archive_scan(archivepath, jobs=1):
+	# as dir_scan, for the members of an archive
+	filepaths = [os.path.join(archivepath, name) for name in archive_list(archivepath)]
+	if jobs > 1:
+		with ThreadPoolExecutor(jobs) as executor:
+			headers = list(executor.map(file_get_header, filepaths))
+	else:
+		headers = [file_get_header(filepath) for filepath in filepaths]
+	return [(filepath, header) for filepath, header in zip(filepaths, headers) if header is not None]
+
+def file_open(filename):
+	# binary file object of a file or an archive member
+	member = archive_split(filename) if not os.path.exists(filename) else None
+	if member is None:
+		return open(filename, "rb")
+	archive, lock = _archive_open(member[0])
+	if type(archive) is zipfile.ZipFile:
+		# members of a zip archive are decompressed only as far as they are read
+		return archive.open(member[1])
+	# a tar archive is a single stream, thus a member is read at once
+	with lock:
+		fp = archive.extractfile(member[1])
+		if fp is None:
+			raise FileNotFoundError(filename)
+		return io.BytesIO(fp.read())
+
+def dcmread(filename, **kwargs):
+	# pydicom.dcmread of a file or an archive member
+	with file_open(filename) as fp:
+		return pydicom.dcmread(fp, **kwargs)
+
+
+############
+# manifest #
+############
+
+# a manifest lists the DICOM files of a series, one path per line, relative to the directory of the manifest
+# it may be given instead of a directory wherever a set of DICOM files is expected
+
+MANIFEST_EXT = ".manifest"
+
+def manifest_write(path, filepaths):
+	dirpath = os.path.dirname(path)
+	with open(path, "w") as fp:
+		for filepath in filepaths:
+			fp.write(os.path.relpath(filepath, dirpath or ".") + "\n")
+
+def manifest_read(path):
+	dirpath = os.path.dirname(path)
+	with open(path) as fp:
+		return [os.path.join(dirpath, line.rstrip("\n")) for line in fp if line.strip()]
+
+def _manifest_entry(filepath, row):
+	# as _scan_entry, for a file listed in a manifest; archive members are not cached
+	if not os.path.exists(filepath):
+		return file_get_header(filepath), None
+	stat = os.stat(filepath)
+	if row is not None and row[0] == stat.st_size and row[1] == stat.st_mtime_ns:
+		return json.loads(row[2]), None
+	header = file_get_header(filepath)
+	return header, (os.path.basename(filepath), stat.st_size, stat.st_mtime_ns, json.dumps(header))
+
+def manifest_scan(path, index=True, jobs=1):
+	# only the listed files are parsed, unless their header is cached in the index of their directory
+	filepaths = manifest_read(path)
+	dirpaths = [os.path.dirname(filepath) or "." for filepath in filepaths]
+	connections = {}
+	rows = [None] * len(filepaths)
+	if index:
+		for i, (filepath, dirpath) in enumerate(zip(filepaths, dirpaths)):
+			if not os.path.isfile(filepath):
+				continue
+			if dirpath not in connections:
+				connections[dirpath] = _index_connect(dirpath)
+			if connections[dirpath] is not None:
+				rows[i] = connections[dirpath].execute("SELECT size, mtime, header FROM headers WHERE name = ?", (os.path.basename(filepath),)).fetchone()
+	if jobs > 1:
+		with ThreadPoolExecutor(jobs) as executor:
+			results = list(executor.map(_manifest_entry, filepaths, rows))
+	else:
+		results = list(map(_manifest_entry, filepaths, rows))
+	files = [(filepath, header) for filepath, (header, update) in zip(filepaths, results) if header is not None]
+	for dirpath, connection in connections.items():
+		if connection is not None:
+			with connection:
+				connection.executemany("INSERT OR REPLACE INTO headers VALUES (?, ?, ?, ?)", [
+					update for (header, update), d in zip(results, dirpaths) if update is not None and d == dirpath
+				])
+			connection.close()
+	return files
+
+
 ########
 # csa2 #
 ########
 
 # http://nipy.org/nibabel/dicom/siemens_csa.html
 
-def csa2_decode(arr):
+# tag: name, VM, VR, SyngoDT, number of items, unused 77 or 205
+_csa2_tag = struct.Struct("<64sI4sII4x")
+# item: length, unused x 3
+_csa2_item = struct.Struct("<I12x")
+
+def csa2_decode(arr, keys=None):
+	# in case keys is given, only these keys are decoded
+	arr = memoryview(arr)
 	assert arr[0:4] == b"SV10"
 	# arr[4:8] # unused
-	ntags = int.from_bytes(arr[8:12], "little")
-	# int.from_bytes(arr[12:16], "little") # unused 77
+	ntags = struct.unpack_from("<I", arr, 8)[0]
+	# arr[12:16] # unused 77
 	i = 16
 	hdr = OrderedDict()
 	for ctags in range(0, ntags):
-		key = arr[i:i+64].split(bytes(1), 1)[0].decode()
-		hdr[key] = {}
-		hdr[key]["VM"] = int.from_bytes(arr[i+64:i+68], "little")
-		hdr[key]["VR"] = arr[i+68:i+72].split(bytes(1), 1)[0].decode()
-		hdr[key]["SyngoDT"] = int.from_bytes(arr[i+72:i+76], "little")
-		nitems = int.from_bytes(arr[i+76:i+80], "little")
-		# int.from_bytes(arr[80:84], "little") # unused 77 or 205
-		i += 84
-		hdr[key]["Data"] = []
+		name, vm, vr, syngodt, nitems = _csa2_tag.unpack_from(arr, i)
+		i += _csa2_tag.size
+		key = name.split(bytes(1), 1)[0].decode()
+		if keys is not None and key not in keys:
+			for citems in range(nitems):
+				item_len = _csa2_item.unpack_from(arr, i)[0]
+				i += _csa2_item.size + (item_len + 3) // 4 * 4
+			continue
+		data = []
 		for citems in range(nitems):
-			item_len = int.from_bytes(arr[i:i+4], "little")
-			# int.from_bytes(arr[i+4:i+8], "little") # unused
-			# int.from_bytes(arr[i+8:i+12], "little") # unused
-			# int.from_bytes(arr[i+12:i+16], "little") # unused
+			item_len = _csa2_item.unpack_from(arr, i)[0]
+			i += _csa2_item.size
 			if item_len:
-				hdr[key]["Data"].append(arr[i+16:i+16+item_len].split(bytes(1), 1)[0].decode())
+				data.append(bytes(arr[i:i+item_len]).split(bytes(1), 1)[0].decode())
 			else:
-				hdr[key]["Data"].append(None)
-			i += 16 + math.ceil(item_len / 4) * 4
+				data.append(None)
+			i += (item_len + 3) // 4 * 4
+		hdr[key] = {"VM": vm, "VR": vr.split(bytes(1), 1)[0].decode(), "SyngoDT": syngodt, "Data": data}
+		if keys is not None and len(hdr) == len(keys):
+			break
 	return hdr
 
 def csa2_encode(hdr):
-	arr = b""
-	arr += b"SV10"
-	arr += bytes(4) # unused
-	arr += len(hdr).to_bytes(4, "little")
-	arr += bytes(4) # unused 77
+	arr = [b"SV10", bytes(4), struct.pack("<I", len(hdr)), bytes(4)] # unused, number of tags, unused 77
 	for key, val in hdr.items():
-		arr += key.encode().ljust(64, bytes(1))
-		arr += val["VM"].to_bytes(4, "little")
-		arr += val["VR"].encode().ljust(4, bytes(1))
-		arr += val["SyngoDT"].to_bytes(4, "little")
-		arr += len(val["Data"]).to_bytes(4, "little")
-		arr += bytes(4) # unused 77 or 205
+		arr.append(_csa2_tag.pack(key.encode(), val["VM"], val["VR"].encode(), val["SyngoDT"], len(val["Data"])))
 		for dat in val["Data"]:
 			item_len = len(dat) + 1 if dat is not None else 0
-			arr += item_len.to_bytes(4, "little")
-			arr += bytes(4) # unused
-			arr += bytes(4) # unused
-			arr += bytes(4) # unused
+			arr.append(_csa2_item.pack(item_len))
 			if item_len:
-				arr += dat.encode().ljust(math.ceil(item_len / 4) * 4, bytes(1))
-	arr += bytes(4) # append one more zero
-	return arr
+				arr.append(dat.encode().ljust((item_len + 3) // 4 * 4, bytes(1)))
+	arr.append(bytes(4)) # append one more zero
+	return b"".join(arr)
+
+def csa2_offsets(arr):
+	# offsets of the items of each key, as needed by csa2_patch
+	arr = memoryview(arr)
+	ntags = struct.unpack_from("<I", arr, 8)[0]
+	i = 16
+	offsets = {}
+	for ctags in range(0, ntags):
+		name, vm, vr, syngodt, nitems = _csa2_tag.unpack_from(arr, i)
+		i += _csa2_tag.size
+		key = name.split(bytes(1), 1)[0].decode()
+		offsets[key] = []
+		for citems in range(nitems):
+			offsets[key].append(i)
+			item_len = _csa2_item.unpack_from(arr, i)[0]
+			i += _csa2_item.size + (item_len + 3) // 4 * 4
+	return offsets
+
+def csa2_patch(arr, offsets, hdr, keys):
+	# copy the items of keys from hdr to the encoded bytearray arr in place
+	# return False if an item does not fit, in which case arr is partially patched and should be encoded again
+	for key in keys:
+		if len(hdr[key]["Data"]) != len(offsets[key]):
+			return False
+		for i, dat in zip(offsets[key], hdr[key]["Data"]):
+			size = (_csa2_item.unpack_from(arr, i)[0] + 3) // 4 * 4
+			item_len = len(dat) + 1 if dat is not None else 0
+			dat = dat.encode().ljust((item_len + 3) // 4 * 4, bytes(1)) if item_len else b""
+			if len(dat) != size:
+				return False
+			_csa2_item.pack_into(arr, i, item_len)
+			arr[i+_csa2_item.size:i+_csa2_item.size+size] = dat
+	return True
 
 def csa2_diff(hdr1, hdr2):
 	keys1 = iter(sorted(hdr1.keys()))
@@ -181,6 +598,297 @@ def csa2_diff(hdr1, hdr2):
 		key2 = next(keys2, None)
 
 
+##########
+# mosaic #
+##########
+
+# http://nipy.org/nibabel/dicom/dicom_mosaic.html
+# tiles of rows x columns pixels fill the mosaic row by row, from left to right
+# any leading axes, e.g. volumes, are processed at once
+
+def mosaic_untile(mosaic, rows, columns, nslices):
+	# (..., Rows, Columns) mosaics to (..., nslices, rows, columns) tiles
+	nrows, ncolumns = mosaic.shape[-2] // rows, mosaic.shape[-1] // columns
+	assert nslices <= nrows * ncolumns, "mosaic does not contain {} tiles".format(nslices)
+	lead = mosaic.shape[:-2]
+	tiles = mosaic[..., :nrows * rows, :ncolumns * columns].reshape(lead + (nrows, rows, ncolumns, columns))
+	tiles = tiles.swapaxes(-3, -2).reshape(lead + (nrows * ncolumns, rows, columns))
+	return tiles[..., :nslices, :, :]
+
+def mosaic_tile(tiles, Rows, Columns):
+	# (..., nslices, rows, columns) tiles to (..., Rows, Columns) mosaics; unused pixels are zero
+	nslices, rows, columns = tiles.shape[-3:]
+	nrows, ncolumns = Rows // rows, Columns // columns
+	assert nslices <= nrows * ncolumns, "{} tiles do not fit in the mosaic".format(nslices)
+	lead = tiles.shape[:-3]
+	mosaic = numpy.zeros(lead + (Rows, Columns), tiles.dtype)
+	# view of the mosaic as (..., nrows, ncolumns, rows, columns) tiles
+	grid = mosaic[..., :nrows * rows, :ncolumns * columns].reshape(lead + (nrows, rows, ncolumns, columns)).swapaxes(-3, -2)
+	full = nslices // ncolumns
+	grid[..., :full, :, :, :] = tiles[..., :full * ncolumns, :, :].reshape(lead + (full, ncolumns, rows, columns))
+	if nslices > full * ncolumns:
+		grid[..., full, :nslices - full * ncolumns, :, :] = tiles[..., full * ncolumns:, :, :]
+	return mosaic
+
+
+############
+# template #
+############
+
+# a dataset is encoded once by pydicom.dcmwrite and split around the elements which vary between files
+# then each file is rendered by encoding only the varying elements and joining them with the constant bytes
+# all other elements of the dataset must remain unchanged between template_compile and template_render
+
+def template_compile(dataset, tags):
+	fp = pydicom.filebase.DicomBytesIO()
+	pydicom.dcmwrite(fp, dataset)
+	arr = fp.getvalue()
+	# preamble and file meta information
+	header = pydicom.dataset.FileDataset(None, {}, file_meta=dataset.file_meta, preamble=dataset.preamble)
+	header.is_little_endian = dataset.is_little_endian
+	header.is_implicit_VR = dataset.is_implicit_VR
+	fp = pydicom.filebase.DicomBytesIO()
+	pydicom.dcmwrite(fp, header)
+	start = len(fp.getvalue())
+	assert arr[:start] == fp.getvalue()
+	# split the encoded dataset around the elements in tags
+	tags = set(pydicom.tag.Tag(tag) for tag in tags)
+	fp = pydicom.filebase.DicomBytesIO(arr)
+	fp.seek(start)
+	parts = []
+	pos = 0
+	for elem in pydicom.filereader.data_element_generator(fp, dataset.is_implicit_VR, dataset.is_little_endian):
+		end = fp.tell()
+		if elem.tag in tags:
+			parts.append(arr[pos:start])
+			parts.append(elem.tag)
+			pos = end
+		start = end
+	parts.append(arr[pos:])
+	return {
+		"parts": parts,
+		"is_little_endian": dataset.is_little_endian,
+		"is_implicit_VR": dataset.is_implicit_VR,
+		"is_original_encoding": dataset.is_original_encoding,
+		"encoding": dataset.get("SpecificCharacterSet", pydicom.charset.default_encoding),
+	}
+
+def template_render(template, dataset):
+	fp = pydicom.filebase.DicomBytesIO()
+	fp.is_little_endian = template["is_little_endian"]
+	fp.is_implicit_VR = template["is_implicit_VR"]
+	for part in template["parts"]:
+		if type(part) is bytes:
+			fp.write(part)
+		elif template["is_original_encoding"]:
+			pydicom.filewriter.write_data_element(fp, dataset.get_item(part), template["encoding"])
+		else:
+			elem = pydicom.filewriter.correct_ambiguous_vr_element(dataset[part], dataset, fp.is_little_endian)
+			pydicom.filewriter.write_data_element(fp, elem, template["encoding"])
+	return fp.getvalue()
+
+
+##########
+# window #
+##########
+
+# Window Center & Width are computed as by niftitools.autowindowing, from a sample of the pixels
+# the new values are written in place of the old ones whenever they fit, otherwise the DICOM file is rewritten
+
+def file_sample_pixels(filename, n=niftitools.SAMPLES, seed=0):
+	# sample of the rescaled pixel values of a DICOM file
+	with open(filename, "rb") as fp:
+		dataset = pydicom.dcmread(fp, stop_before_pixels=True)
+		offset, length = _pixel_data_offset(fp, dataset)
+	if offset is not None and dataset.get("SamplesPerPixel", 1) == 1 and dataset.BitsAllocated in (8, 16, 32):
+		# read native pixel data directly
+		dtype = numpy.dtype("<{}{}".format("i" if dataset.PixelRepresentation else "u", dataset.BitsAllocated // 8))
+		data = numpy.fromfile(filename, dtype, length // dtype.itemsize, offset=offset)
+	else:
+		data = pydicom.dcmread(filename).pixel_array.reshape(-1)
+	data = niftitools.sample(data, n=n, seed=seed)
+	if "RescaleSlope" in dataset or "RescaleIntercept" in dataset:
+		data = data * float(dataset.get("RescaleSlope", 1)) + float(dataset.get("RescaleIntercept", 0))
+	return data
+
+def _window_values(value, length):
+	# DS strings of value, padded to length if possible
+	for fmt in ["{:.6g}", "{:.0f}"]:
+		arr = fmt.format(value).encode()
+		if len(arr) <= length:
+			return arr.ljust(length)
+	return None
+
+def file_set_window(filename, center, width):
+	# return True if the values were written in place
+	dataset = pydicom.dcmread(filename, stop_before_pixels=True)
+	patches = []
+	for tag, value in [((0x0028, 0x1050), center), ((0x0028, 0x1051), width)]:
+		elem = dataset.get_item(tag)
+		if elem is None or not isinstance(elem, pydicom.dataelem.RawDataElement) or elem.value_tell is None:
+			break
+		arr = _window_values(value, elem.length)
+		if arr is None:
+			break
+		patches.append((elem.value_tell, arr))
+	if len(patches) == 2:
+		with open(filename, "r+b") as fp:
+			for offset, arr in patches:
+				fp.seek(offset)
+				fp.write(arr)
+		return True
+	dataset = pydicom.dcmread(filename)
+	dataset.WindowCenter = _window_values(center, 16).decode().strip()
+	dataset.WindowWidth = _window_values(width, 16).decode().strip()
+	pydicom.dcmwrite(filename, dataset)
+	return False
+
+def autobrightness(path, per_file=False, index=True, jobs=1):
+	# set the window of a DICOM file, or of each DICOM file of a directory or a manifest, with a pool of jobs threads
+	# a common window is computed for a set of DICOM files, unless per_file
+	if os.path.isdir(path) or path.endswith(MANIFEST_EXT):
+		dicompaths = dir_list_files(path, index=index, jobs=jobs)
+	else:
+		dicompaths = [path]
+	assert dicompaths, "{} does not contain any DICOM file".format(path)
+	executor = ThreadPoolExecutor(jobs) if jobs > 1 else None
+	_map = executor.map if executor is not None else map
+	try:
+		if per_file:
+			windows = list(_map(lambda dicompath: niftitools.window(file_sample_pixels(dicompath)), dicompaths))
+		else:
+			# each DICOM file contributes an equal share of the sample
+			n = max(1, niftitools.SAMPLES // len(dicompaths))
+			window = niftitools.window(numpy.concatenate(list(_map(lambda dicompath: file_sample_pixels(dicompath, n=n), dicompaths))))
+			windows = [window] * len(dicompaths)
+		inplace = 0
+		for i, (dicompath, window, patched) in enumerate(zip(dicompaths, windows, _map(lambda args: file_set_window(args[0], *args[1]), zip(dicompaths, windows)))):
+			print("writing [{}/{}] DICOM file {}; window center {:.6g}, width {:.6g}{}".format(i + 1, len(dicompaths), dicompath, window[0], window[1], "" if patched else "; rewritten"))
+			inplace += patched
+	finally:
+		if executor is not None:
+			executor.shutdown()
+	print("autobrightness complete; {} of {} DICOM files written in place".format(inplace, len(dicompaths)))
+
+
+#######
+# rle #
+#######
+
+# RLE Lossless transfer syntax
+# http://dicom.nema.org/medical/dicom/current/output/chtml/part05/chapter_G.html
+# each byte of a sample, from the most significant, is a segment of PackBits encoded rows
+# runs are encoded as by pydicom: runs of 2 or more bytes are replicate runs, other bytes are merged into literal runs
+
+def rle_encode_segment(plane):
+	# PackBits encoding of the rows of a 2D uint8 array, vectorized over all rows
+	rows, columns = plane.shape
+	x = plane.reshape(-1)
+	boundary = numpy.ones(x.size, bool)
+	boundary[1:] = x[1:] != x[:-1]
+	boundary[::columns] = True
+	starts = numpy.flatnonzero(boundary)
+	lengths = numpy.diff(numpy.append(starts, x.size))
+	values = x[starts]
+	single = lengths == 1
+	# a run is split into items: a literal byte, replicate runs of at most 128 bytes, or a trailing single byte
+	nfull, rem = lengths // 128, lengths % 128
+	counts = numpy.where(single, 1, nfull + (rem > 0))
+	run = numpy.repeat(numpy.arange(len(starts)), counts)
+	k = numpy.arange(len(run)) - numpy.repeat(numpy.cumsum(counts) - counts, counts)
+	length = numpy.where(k < nfull[run], 128, rem[run])
+	literal = single[run]
+	value = values[run]
+	# literal bytes are grouped in runs of at most 128 bytes, which do not cross rows nor other items
+	first = literal.copy()
+	first[1:] &= ~literal[:-1]
+	first |= literal & (starts[run] % columns == 0)
+	m = numpy.flatnonzero(literal)
+	lfirst = first[m]
+	lindex = numpy.arange(len(m))
+	lidx = lindex - numpy.maximum.accumulate(numpy.where(lfirst, lindex, 0))
+	lstretch = numpy.cumsum(lfirst) - 1
+	lremaining = numpy.bincount(lstretch)[lstretch] - lidx
+	group = numpy.zeros(len(run), bool)
+	group[m] = lidx % 128 == 0
+	gsize = numpy.zeros(len(run), numpy.int64)
+	gsize[m] = numpy.minimum(128, lremaining)
+	# output offset of each item
+	sizes = numpy.where(literal, 1 + group, 2)
+	offsets = numpy.cumsum(sizes) - sizes
+	out = numpy.zeros(sizes.sum() + sizes.sum() % 2, numpy.uint8)
+	header = ~literal | group
+	out[offsets[header]] = numpy.where(literal, gsize - 1, numpy.where(length > 1, 257 - length, 0))[header]
+	out[offsets + header] = value
+	return out.tobytes()
+
+def rle_encode_frame(arr):
+	# RLE encoded frame of a 2D array, with the 64 byte header of segment offsets
+	arr = numpy.ascontiguousarray(arr, arr.dtype.newbyteorder("<"))
+	nbytes = arr.dtype.itemsize
+	planes = arr.view(numpy.uint8).reshape(arr.shape + (nbytes,))
+	segments = [rle_encode_segment(planes[..., b]) for b in reversed(range(nbytes))]
+	offsets = numpy.cumsum([64] + [len(segment) for segment in segments[:-1]]).tolist()
+	return struct.pack("<16L", len(segments), *(offsets + [0] * (15 - len(offsets)))) + b"".join(segments)
+
+def rle_encode_element(arr):
+	# encoded Pixel Data (0x7fe0, 0x0010) element of a single frame, in explicit VR little endian
+	# the value is of undefined length, thus ends with a Sequence Delimitation Item
+	return struct.pack("<HH2sHL", 0x7fe0, 0x0010, b"OB", 0, 0xffffffff) + pydicom.encaps.encapsulate([rle_encode_frame(arr)]) + struct.pack("<HHL", 0xfffe, 0xe0dd, 0)
+
+def rle_encode_dataset(dataset, arr):
+	# set Pixel Data (0x7fe0, 0x0010) of a dataset to a single RLE Lossless frame
+	dataset.PixelData = pydicom.encaps.encapsulate([rle_encode_frame(arr)])
+	dataset[0x7fe0, 0x0010].VR = "OB"
+	dataset[0x7fe0, 0x0010].is_undefined_length = True
+
+
+#########
+# write #
+#########
+
+def dcmencode(dataset, pixels=None):
+	# bytes of a DICOM file, as pydicom.dcmwrite would write them
+	# dataset may be already encoded, e.g. by template_render
+	# in case pixels is given, it is encoded as RLE Lossless Pixel Data, which must be the last element
+	if type(dataset) is bytes:
+		return dataset + rle_encode_element(pixels) if pixels is not None else dataset
+	if pixels is not None:
+		rle_encode_dataset(dataset, pixels)
+	fp = pydicom.filebase.DicomBytesIO()
+	pydicom.dcmwrite(fp, dataset)
+	return fp.getvalue()
+
+def _dcmwrite(filename, dataset, pixels=None):
+	with open(filename, "wb") as fp:
+		fp.write(dcmencode(dataset, pixels))
+
+@contextlib.contextmanager
+def dcmwrite_pool(jobs=1, processes=False, inflight=None):
+	# yield a function like pydicom.dcmwrite, which writes with a pool of jobs threads or processes
+	# the dataset is copied, thus the caller may modify it as soon as the function returns
+	# the dataset may also be the bytes of an encoded DICOM file
+	# pixels, if given, are RLE encoded by the pool as well, see dcmencode
+	# at most inflight writes are pending at any time; default 2 * jobs
+	if jobs <= 1:
+		yield _dcmwrite
+		return
+	if inflight is None:
+		inflight = 2 * jobs
+	futures = deque()
+	def dcmwrite(filename, dataset, pixels=None):
+		if len(futures) >= inflight:
+			futures.popleft().result()
+		if type(dataset) is not bytes:
+			dataset = copy.deepcopy(dataset)
+		futures.append(executor.submit(_dcmwrite, filename, dataset, pixels))
+	executor_class = concurrent.futures.ProcessPoolExecutor if processes else ThreadPoolExecutor
+	with executor_class(jobs) as executor:
+		yield dcmwrite
+		while futures:
+			futures.popleft().result()
+
+
 ##########
 # linear #
 ##########
@@ -216,8 +924,8 @@ def linear_datetime(tag, ds0, ds1, ds2):
 # main #
 ########
 
-if __name__ == "__main__":
-	parser = argparse.ArgumentParser()
+def main(argv=None, prog=None):
+	parser = argparse.ArgumentParser(prog=prog)
 	subparsers = parser.add_subparsers(dest="action", help="one of the following actions", metavar="ACTION")
 	subparsers.required = True
 	parser_dataset = subparsers.add_parser("dataset", description="Output the dataset of a DICOM file.", epilog="""
@@ -228,7 +936,15 @@ if __name__ == "__main__":
 	Only (0x0028, 0x1050) Window Center and (0x0028, 0x1051) Window Width tags are affected.
 	""", help="auto-adjust brightness and contrast of a DICOM file")
 	parser_autobrightness.add_argument("path", help="path of a DICOM file or directory of a set of DICOM files", metavar="PATH")
-	args = parser.parse_args()
+	parser_autobrightness.add_argument("-f", "--per-file", action="store_true", help="compute a window for each DICOM file instead of a common window")
+	parser_autobrightness.add_argument("--no-index", action="store_false", help="do not use the header index of the directory", dest="index")
+	parser_autobrightness.add_argument("-j", "--jobs", type=int, default=1, help="number of threads reading and writing DICOM files; default 1")
+	args = parser.parse_args(argv)
 	if args.action == "dataset":
 		dataset = pydicom.dcmread(args.path, stop_before_pixels=True)
 		print(dataset)
+	elif args.action == "autobrightness":
+		autobrightness(args.path, per_file=args.per_file, index=args.index, jobs=args.jobs)
+
+if __name__ == "__main__":
+	main()
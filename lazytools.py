@@ -0,0 +1,54 @@
+import sys
+import types
+import threading
+import importlib
+import importlib.util
+
+# a lazy module is registered in sys.modules as usual, but its code is executed on first access of one of its attributes,
+# thus command lines not using numpy, nibabel or pydicom do not pay for importing them
+# the first access is serialized by a lock, as a module may be first used by a pool of threads,
+# and reentrant accesses by the thread executing the module, e.g. by its submodules, see the partially executed module
+
+_lock = threading.RLock()
+
+def _load(module):
+	with _lock:
+		if object.__getattribute__(module, "__class__") is not _LazyModule:
+			return
+		spec = object.__getattribute__(module, "__spec__")
+		if spec.loader_state["loading"]:
+			return
+		spec.loader_state["loading"] = True
+		try:
+			spec.loader.exec_module(module)
+		except BaseException:
+			sys.modules.pop(spec.name, None)
+			raise
+		finally:
+			spec.loader_state["loading"] = False
+		object.__setattr__(module, "__class__", types.ModuleType)
+
+class _LazyModule(types.ModuleType):
+	def __getattribute__(self, attr):
+		_load(self)
+		return types.ModuleType.__getattribute__(self, attr)
+
+	def __setattr__(self, attr, value):
+		_load(self)
+		types.ModuleType.__setattr__(self, attr, value)
+
+def lazy_import(name):
+	# as importlib.import_module, deferring the execution of a top level module
+	if name in sys.modules:
+		return sys.modules[name]
+	spec = importlib.util.find_spec(name)
+	if spec is None:
+		# as import, thus optional dependencies may be tried with except ImportError
+		raise ModuleNotFoundError("No module named {!r}".format(name), name=name)
+	if "." in name or not hasattr(spec.loader, "exec_module"):
+		return importlib.import_module(name)
+	module = importlib.util.module_from_spec(spec)
+	spec.loader_state = {"loading": False}
+	object.__setattr__(module, "__class__", _LazyModule)
+	sys.modules[name] = module
+	return module
@@ -4,39 +4,63 @@
 
 import argparse
 import os
+import io
 import copy
 import re
 import datetime
 import math
 
-import numpy
-import nibabel
-import pydicom
-
+import lazytools
 import dicomtools
 import niftitools
+import proftools
 
-def nifti2dicom(path):
-	# find NIfTI files
-	if os.path.isfile(path):
-		assert re.search("\.nii(?:\.gz)$", path, flags=re.I), "{} is not a NIfTI file".format(path)
-		niftipaths = [path]
-		dirpath = os.path.dirname(path)
-	elif os.path.isdir(path):
-		niftipaths = [os.path.join(path, filename) for filename in os.listdir(path) if re.search("\.nii(?:\.gz)$", filename, flags=re.I)]
-		dirpath = path
-	else:
-		assert False, "{} is neither a file nor a directory".format(path)
-	# find DICOM files
-	dicompaths = dicomtools.dir_list_files(dirpath)
-	assert len(dicompaths) >= 2, "directory {} must contain at least two DICOM files".format(dirpath)
-	# read first and last DICOM files
-	dataset1 = pydicom.dcmread(dicompaths[0], stop_before_pixels=True)
-	dataset2 = pydicom.dcmread(dicompaths[-1], stop_before_pixels=True)
-	# calculate NIfTI affine
+numpy = lazytools.lazy_import("numpy")
+nibabel = lazytools.lazy_import("nibabel")
+pydicom = lazytools.lazy_import("pydicom")
+
+# elements which vary between the DICOM files of a NIfTI file
+_slice_tags = [
+	(0x0008, 0x0012), (0x0008, 0x0013), # Instance Creation Date & Time
+	(0x0008, 0x0018), # SOP Instance UID
+	(0x0008, 0x0022), (0x0008, 0x0032), # Acquisition Date & Time
+	(0x0008, 0x0023), (0x0008, 0x0033), # Content Date & Time
+	(0x0019, 0x1015), (0x0019, 0x1016), (0x0019, 0x10a2), # SIEMENS MR HEADER or GEMS_ACQU_01
+	(0x0020, 0x0012), # Acquisition Number
+	(0x0020, 0x0013), # Instance Number
+	(0x0020, 0x0032), # Image Position (Patient)
+	(0x0020, 0x1041), # Slice Location
+	(0x0028, 0x0106), (0x0028, 0x0107), # Smallest & Largest Image Pixel Value
+	(0x0029, 0x1010), # CSA Image Header Info
+	(0x2001, 0x100a), # Slice Number MR
+	(0x2005, 0x1008), (0x2005, 0x1009), (0x2005, 0x100a), # Philips MR Imaging DD 001
+	(0x7fe0, 0x0010), # Pixel Data
+]
+
+# Window Center & Width, which vary between the DICOM files in case of a window per DICOM file
+_window_tags = [(0x0028, 0x1050), (0x0028, 0x1051)]
+
+# items of the CSA Image Header Info which vary between the DICOM files of a NIfTI file
+_csa_slice_keys = ["Actual3DImaPartNumber", "ProtocolSliceNumber", "SlicePosition_PCS", "TimeAfterStart"]
+
+def _reference(reference):
+	# dataset of a reference DICOM file given as a dataset, bytes or a path
+	if type(reference) in [bytes, bytearray]:
+		reference = io.BytesIO(reference)
+	if not isinstance(reference, pydicom.dataset.Dataset):
+		reference = pydicom.dcmread(reference, stop_before_pixels=True)
+	return reference
+
+def _slices(nifti, dataset1, dataset2, description, template=True, window="series", rle=False, profile=None, dirpath=None):
+	# yield (filename, dataset, pixels) for each DICOM file of a NIfTI image, where dataset is encoded from the template if template
+	# the dataset is reused between DICOM files, and pixels are RLE encoded by the consumer, see dicomtools.dcmencode
+	# a line per DICOM file is printed in case the DICOM files are written to dirpath
 	shape, zooms, affine = dicomtools.get_affine(dataset1, dataset2)
 	# prepare common DICOM dataset
 	dataset = copy.deepcopy(dataset1)
+	# (0x7fe0, 0x0010) Pixel Data of a reference read with its pixels, replaced for each DICOM file
+	if (0x7fe0, 0x0010) in dataset:
+		del dataset[0x7fe0, 0x0010]
 	# (0x0008, 0x2112) Source Image Sequence
 	if (0x0008, 0x2112) in dataset:
 		del dataset[0x0008, 0x2112]
@@ -50,6 +74,9 @@ def nifti2dicom(path):
 	if (0x0029, 0x0010) in dataset and dataset[0x0029, 0x0010].value == "SIEMENS CSA HEADER":
 		# (0x0029, 0x1010) CSA Image Header Info
 		csa_image_header_info = dicomtools.csa2_decode(dataset[0x0029, 0x1010].value)
+		# encode once, then patch only the items which vary between DICOM files
+		csa_arr = bytearray(dicomtools.csa2_encode(csa_image_header_info))
+		csa_offsets = dicomtools.csa2_offsets(csa_arr)
 	if (0x0043, 0x0010) in dataset and dataset[0x0043, 0x0010].value == "GEMS_PARM_01":
 		# (0x0043, 0x1028) Unique image iden
 		if (0x0043, 0x1028) in dataset:
@@ -74,132 +101,221 @@ def nifti2dicom(path):
 		# (0x2001, 0x9000) Unknown
 		if (0x2001, 0x9000) in dataset:
 			del dataset[0x2001, 0x9000]
-	for nifticnt, niftipath in enumerate(niftipaths):
-		print("reading [{}/{}] NIfTI file {}".format(nifticnt + 1, len(niftipaths), niftipath))
-		# reorient NIfTI image
-		nifti = nibabel.load(niftipath)
-		ornt = nibabel.io_orientation(numpy.linalg.solve(affine, nifti.get_affine()))
-		nifti = nifti.as_reoriented(ornt)
-		shape = nifti.get_shape()
+	if rle:
+		# (0x0002, 0x0010) Transfer Syntax UID; RLE Lossless is explicit VR little endian
+		dataset.file_meta.TransferSyntaxUID = pydicom.uid.RLELossless
+		dataset.is_implicit_VR = False
+		dataset.is_little_endian = True
+	# reorient NIfTI image
+	ornt = nibabel.io_orientation(numpy.linalg.solve(affine, nifti.get_affine()))
+	shape = niftitools.reorient_shape(nifti.shape, ornt)
+	# customize common DICOM tags
+	dataset.SeriesDescription = description
+	dataset.ProtocolName = dataset.SeriesDescription
+	dataset.SeriesInstanceUID = pydicom.uid.generate_uid()
+	if window == "series":
+		with proftools.stage(profile, "window"):
+			dataset.WindowCenter, dataset.WindowWidth = niftitools.autowindowing(nifti)
+	# reading the NIfTI file is timed with its reorientation
+	for f, data in enumerate(proftools.iterate(profile, "reorient", niftitools.reoriented_slices(nifti, ornt))):
 		# prepare DICOM pixel data by transposing NIfTI data
-		data = nifti.get_data().swapaxes(0, 1)
-		# customize common DICOM tags
-		dataset.SeriesDescription = re.sub("\.nii(?:\.gz)$", "", os.path.split(niftipath)[-1], flags=re.I)
-		dataset.ProtocolName = dataset.SeriesDescription
-		dataset.SeriesInstanceUID = pydicom.uid.generate_uid()
-		dataset.WindowCenter, dataset.WindowWidth = niftitools.autowindowing(nifti)
-		# save DICOM files
-		subdirname = dicomtools.get_series(dataset) + datetime.datetime.now().strftime("-%Y%m%d%H%M%S")
-		subdirpath = os.path.join(dirpath, subdirname)
-		assert not os.path.exists(subdirpath)
-		os.mkdir(subdirpath)
-		for f in range(shape[-1]):
-			dicomname = str(f).zfill(math.floor(math.log10(shape[-1])) + 1) + ".dcm"
-			dicompath = os.path.join(subdirpath, dicomname)
-			# (0x0020, 0x0013) Instance Number
-			dataset.InstanceNumber = f + 1
-			# (0x0008, 0x0012) & (0x0008, 0x0013) Instance Creation Date & Time
-			if (0x0008, 0x0012) in dataset and (0x0008, 0x0013) in dataset:
-				dicomtools.linear_datetime("InstanceCreation", dataset, dataset1, dataset2)
-			# (0x0008, 0x0018) SOP Instance UID
-			if (0x0008, 0x0018) in dataset:
-				dataset[0x0008, 0x0018].value = pydicom.uid.generate_uid()
-			# (0x0008, 0x0022) & (0x0008, 0x0032) Acquisition Date & Time
-			dicomtools.linear_datetime("Acquisition", dataset, dataset1, dataset2)
-			# (0x0008, 0x0023) & (0x0008, 0x0033) Content Date & Time
-			dicomtools.linear_datetime("Content", dataset, dataset1, dataset2)
-			if len(shape) == 4: # TODO nifti2dicom DTI
-				# (0x0020, 0x0012) Acquisition Number
-				dataset.AcquisitionNumber = f + 1
-				data_slice = numpy.zeros((dataset.Rows, dataset.Columns), data.dtype)
-				jinc = shape[1]
-				jbeg, jend = 0, jinc
-				iinc = shape[0]
-				ibeg, iend = 0, iinc
-				for k in range(shape[2]):
-					data_slice[jbeg:jend, ibeg:iend] = data[:, :, k, f]
-					ibeg, iend = ibeg + iinc, iend + iinc
-					if iend > dataset1.Columns:
-						ibeg, iend = 0, iinc
-						jbeg, jend = jbeg + jinc, jend + jinc
-			else:
-				data_slice = data[:, :, f]
-			if (0x0019, 0x0010) in dataset and dataset[0x0019, 0x0010].value == "SIEMENS MR HEADER":
-				# (0x0019, 0x1015) SlicePosition_PCS
-				if (0x0019, 0x1015) in dataset:
-					dicomtools.linear_float_array((0x0019, 0x1015), dataset, dataset1, dataset2)
-				# (0x0019, 0x1016) TimeAfterStart
-				if (0x0019, 0x1016) in dataset:
-					dicomtools.linear_float((0x0019, 0x1016), dataset, dataset1, dataset2)
-			elif (0x0019, 0x0010) in dataset and dataset[0x0019, 0x0010].value in ["GEMS_ACQU_01", "GEMS_IDEN_01"]:
-				# (0x0019, 0x10a2) Raw data run number
-				if (0x0019, 0x10a2) in dataset:
-					dataset[0x0019, 0x10a2].value = (int.from_bytes(dataset1[0x0019, 0x10a2], "little") + dataset.InstanceNumber - dataset1.InstanceNumber).to_bytes(4, "little")
-				# TODO (0x0019, 0x10??) User data ??
-			# (0x0020, 0x0032) Image Position (Patient)
-			if (0x0020, 0x0032) in dataset:
-				dicomtools.linear_float_array((0x0020, 0x0032), dataset, dataset1, dataset2)
-			# (0x0020, 0x1041) Slice Location
-			if (0x0020, 0x1041) in dataset:
-				dicomtools.linear_float((0x0020, 0x1041), dataset, dataset1, dataset2)
-			# TODO (0x0020, 0x9057) In-Stack Position Number ge-t1 and ge-dti
-			if (0x0027, 0x0010) in dataset and dataset[0x0027, 0x0010] == "GEMS_IMAG_01":
-				# TODO (0x0027, 0x1040) RAS letter of image location b"S " if SliceLocation >= 0 else b"I "
-				# TODO (0x0027, 0x1041) Image location e.g. b"Qj\xbd\xc2"
-				pass
-			# (0x0028, 0x0106) Smallest Image Pixel Value
-			if (0x0028, 0x0106) in dataset:
-				dataset[0x0028, 0x0106].value = data_slice.min()
-			# (0x0028, 0x0107) Largest Image Pixel Value
-			if (0x0028, 0x0107) in dataset:
-				dataset[0x0028, 0x0107].value = data_slice.max()
-			# (0x0028, 0x1052) Rescale Intercept
-			if (0x0028, 0x1052) in dataset:
-				dataset[0x0028, 0x1052].value = 0
-			# (0x0028, 0x1053) Rescale Slope
-			if (0x0028, 0x1053) in dataset:
-				dataset[0x0028, 0x1053].value = 1
-			if (0x0029, 0x0010) in dataset and dataset[0x0029, 0x0010].value == "SIEMENS CSA HEADER":
-				# (0x0029, 0x1010) CSA Image Header Info
-				if csa_image_header_info["Actual3DImaPartNumber"]["Data"]:
-					csa_image_header_info["Actual3DImaPartNumber"]["Data"][0] = str(f).ljust(8)
-				elif not csa_image_header_info["MosaicRefAcqTimes"]["Data"]: # TODO linear int on csa_image_header_info
-					csa_image_header_info["ProtocolSliceNumber"]["Data"][0] = str(f).ljust(8)
-				# csa_image_header_info["GSWDDataType"] CORONAL
-				# csa_image_header_info["RFSWDDataType"] CORONAL
-				# csa_image_header_info["ICE_Dims"]["Data"][0] *
-				# csa_image_header_info["MosaicRefAcqTimes"]["Data"] FMRI
-				# csa_image_header_info["SliceMeasurementDuration"]["Data"][0] CORONAL
-				csa_image_header_info["SlicePosition_PCS"]["Data"][0:3] = ["{:.8f}".format(x) for x in dataset.ImagePositionPatient]
-				if csa_image_header_info["TimeAfterStart"]["Data"]:
-					csa_image_header_info["TimeAfterStart"]["Data"][0] = "{:.8f}".format(dataset[0x0019, 0x1016].value)
-				dataset[0x0029, 0x1010].value = dicomtools.csa2_encode(csa_image_header_info)
-			if (0x2001, 0x0010) in dataset and dataset[0x2001, 0x0010].value == "Philips Imaging DD 001":
-				# (0x2001, 0x100a) Slice Number MR
-				if (0x2001, 0x100a) in dataset:
-					dataset[0x2001, 0x100a].value = f + 1
-			if (0x2005, 0x0010) in dataset and dataset[0x2005, 0x0010].value == "Philips MR Imaging DD 001":
-				# (0x2005, 0x1008) Unknown
-				if (0x2005, 0x1008) in dataset:
-					dicomtools.linear_float((0x2005, 0x1008), dataset, dataset1, dataset2)
-				# (0x2005, 0x1009) Unknown
-				if (0x2005, 0x1009) in dataset:
-					dicomtools.linear_float((0x2005, 0x1009), dataset, dataset1, dataset2)
-				# (0x2005, 0x100a) Unknown
-				if (0x2005, 0x100a) in dataset:
-					dicomtools.linear_float((0x2005, 0x100a), dataset, dataset1, dataset2)
-			# assuming data.dtype.itemsize == 2; thus VR="OW" (Other Word) and not "OB" (Other Byte)
-			# http://dicom.nema.org/medical/dicom/current/output/chtml/part03/sect_C.7.6.3.html
-			# http://dicom.nema.org/medical/dicom/current/output/chtml/part05/sect_6.2.html
-			# (0x7fe0, 0x0010) Pixel Data
+		data = data.swapaxes(0, 1)
+		dicomname = str(f).zfill(math.floor(math.log10(shape[-1])) + 1) + ".dcm"
+		# (0x0020, 0x0013) Instance Number
+		dataset.InstanceNumber = f + 1
+		# (0x0008, 0x0012) & (0x0008, 0x0013) Instance Creation Date & Time
+		if (0x0008, 0x0012) in dataset and (0x0008, 0x0013) in dataset:
+			dicomtools.linear_datetime("InstanceCreation", dataset, dataset1, dataset2)
+		# (0x0008, 0x0018) SOP Instance UID
+		if (0x0008, 0x0018) in dataset:
+			dataset[0x0008, 0x0018].value = pydicom.uid.generate_uid()
+		# (0x0008, 0x0022) & (0x0008, 0x0032) Acquisition Date & Time
+		dicomtools.linear_datetime("Acquisition", dataset, dataset1, dataset2)
+		# (0x0008, 0x0023) & (0x0008, 0x0033) Content Date & Time
+		dicomtools.linear_datetime("Content", dataset, dataset1, dataset2)
+		if len(shape) == 4: # TODO nifti2dicom DTI
+			# (0x0020, 0x0012) Acquisition Number
+			dataset.AcquisitionNumber = f + 1
+			with proftools.stage(profile, "mosaic"):
+				data_slice = dicomtools.mosaic_tile(data.transpose(2, 0, 1), dataset.Rows, dataset.Columns)
+		else:
+			data_slice = data
+		if window == "file":
+			# (0x0028, 0x1050) & (0x0028, 0x1051) Window Center & Width of a slice or volume
+			with proftools.stage(profile, "window"):
+				dataset.WindowCenter, dataset.WindowWidth = niftitools.autowindowing(data)
+		if (0x0019, 0x0010) in dataset and dataset[0x0019, 0x0010].value == "SIEMENS MR HEADER":
+			# (0x0019, 0x1015) SlicePosition_PCS
+			if (0x0019, 0x1015) in dataset:
+				dicomtools.linear_float_array((0x0019, 0x1015), dataset, dataset1, dataset2)
+			# (0x0019, 0x1016) TimeAfterStart
+			if (0x0019, 0x1016) in dataset:
+				dicomtools.linear_float((0x0019, 0x1016), dataset, dataset1, dataset2)
+		elif (0x0019, 0x0010) in dataset and dataset[0x0019, 0x0010].value in ["GEMS_ACQU_01", "GEMS_IDEN_01"]:
+			# (0x0019, 0x10a2) Raw data run number
+			if (0x0019, 0x10a2) in dataset:
+				dataset[0x0019, 0x10a2].value = (int.from_bytes(dataset1[0x0019, 0x10a2], "little") + dataset.InstanceNumber - dataset1.InstanceNumber).to_bytes(4, "little")
+			# TODO (0x0019, 0x10??) User data ??
+		# (0x0020, 0x0032) Image Position (Patient)
+		if (0x0020, 0x0032) in dataset:
+			dicomtools.linear_float_array((0x0020, 0x0032), dataset, dataset1, dataset2)
+		# (0x0020, 0x1041) Slice Location
+		if (0x0020, 0x1041) in dataset:
+			dicomtools.linear_float((0x0020, 0x1041), dataset, dataset1, dataset2)
+		# TODO (0x0020, 0x9057) In-Stack Position Number ge-t1 and ge-dti
+		if (0x0027, 0x0010) in dataset and dataset[0x0027, 0x0010] == "GEMS_IMAG_01":
+			# TODO (0x0027, 0x1040) RAS letter of image location b"S " if SliceLocation >= 0 else b"I "
+			# TODO (0x0027, 0x1041) Image location e.g. b"Qj\xbd\xc2"
+			pass
+		# (0x0028, 0x0106) Smallest Image Pixel Value
+		if (0x0028, 0x0106) in dataset:
+			dataset[0x0028, 0x0106].value = data_slice.min()
+		# (0x0028, 0x0107) Largest Image Pixel Value
+		if (0x0028, 0x0107) in dataset:
+			dataset[0x0028, 0x0107].value = data_slice.max()
+		# (0x0028, 0x1052) Rescale Intercept
+		if (0x0028, 0x1052) in dataset:
+			dataset[0x0028, 0x1052].value = 0
+		# (0x0028, 0x1053) Rescale Slope
+		if (0x0028, 0x1053) in dataset:
+			dataset[0x0028, 0x1053].value = 1
+		if (0x0029, 0x0010) in dataset and dataset[0x0029, 0x0010].value == "SIEMENS CSA HEADER":
+			# (0x0029, 0x1010) CSA Image Header Info
+			if csa_image_header_info["Actual3DImaPartNumber"]["Data"]:
+				csa_image_header_info["Actual3DImaPartNumber"]["Data"][0] = str(f).ljust(8)
+			elif not csa_image_header_info["MosaicRefAcqTimes"]["Data"]: # TODO linear int on csa_image_header_info
+				csa_image_header_info["ProtocolSliceNumber"]["Data"][0] = str(f).ljust(8)
+			# csa_image_header_info["GSWDDataType"] CORONAL
+			# csa_image_header_info["RFSWDDataType"] CORONAL
+			# csa_image_header_info["ICE_Dims"]["Data"][0] *
+			# csa_image_header_info["MosaicRefAcqTimes"]["Data"] FMRI
+			# csa_image_header_info["SliceMeasurementDuration"]["Data"][0] CORONAL
+			csa_image_header_info["SlicePosition_PCS"]["Data"][0:3] = ["{:.8f}".format(x) for x in dataset.ImagePositionPatient]
+			if csa_image_header_info["TimeAfterStart"]["Data"]:
+				csa_image_header_info["TimeAfterStart"]["Data"][0] = "{:.8f}".format(dataset[0x0019, 0x1016].value)
+			if not dicomtools.csa2_patch(csa_arr, csa_offsets, csa_image_header_info, _csa_slice_keys):
+				csa_arr = bytearray(dicomtools.csa2_encode(csa_image_header_info))
+				csa_offsets = dicomtools.csa2_offsets(csa_arr)
+			dataset[0x0029, 0x1010].value = bytes(csa_arr)
+		if (0x2001, 0x0010) in dataset and dataset[0x2001, 0x0010].value == "Philips Imaging DD 001":
+			# (0x2001, 0x100a) Slice Number MR
+			if (0x2001, 0x100a) in dataset:
+				dataset[0x2001, 0x100a].value = f + 1
+		if (0x2005, 0x0010) in dataset and dataset[0x2005, 0x0010].value == "Philips MR Imaging DD 001":
+			# (0x2005, 0x1008) Unknown
+			if (0x2005, 0x1008) in dataset:
+				dicomtools.linear_float((0x2005, 0x1008), dataset, dataset1, dataset2)
+			# (0x2005, 0x1009) Unknown
+			if (0x2005, 0x1009) in dataset:
+				dicomtools.linear_float((0x2005, 0x1009), dataset, dataset1, dataset2)
+			# (0x2005, 0x100a) Unknown
+			if (0x2005, 0x100a) in dataset:
+				dicomtools.linear_float((0x2005, 0x100a), dataset, dataset1, dataset2)
+		# assuming data.dtype.itemsize == 2; thus VR="OW" (Other Word) and not "OB" (Other Byte)
+		# http://dicom.nema.org/medical/dicom/current/output/chtml/part03/sect_C.7.6.3.html
+		# http://dicom.nema.org/medical/dicom/current/output/chtml/part05/sect_6.2.html
+		# (0x7fe0, 0x0010) Pixel Data
+		# in case of RLE, Pixel Data is encoded by the consumer, e.g. by the workers of the pool, and appended to the dataset
+		pixels = data_slice if rle else None
+		if not rle:
 			dataset.add_new((0x7fe0, 0x0010), "OW",  data_slice.tobytes())
-			# NOTE (0xfffc, 0xfffc) Data Set Trailing Padding
-			print("writing [{}/{}] DICOM file {}".format(f + 1, shape[-1], dicompath))
-			pydicom.dcmwrite(dicompath, dataset)
-	print("nifti2dicom complete")
+		# NOTE (0xfffc, 0xfffc) Data Set Trailing Padding
+		if dirpath is not None:
+			print("writing [{}/{}] DICOM file {}".format(f + 1, shape[-1], os.path.join(dirpath, dicomname)))
+		if template:
+			# encode the constant elements only once per NIfTI file
+			with proftools.stage(profile, "encode"):
+				if f == 0:
+					dataset_template = dicomtools.template_compile(dataset, _slice_tags + (_window_tags if window == "file" else []))
+				arr = dicomtools.template_render(dataset_template, dataset)
+			yield dicomname, arr, pixels
+		else:
+			yield dicomname, dataset, pixels
 
-if __name__ == "__main__":
-	parser = argparse.ArgumentParser(description="Convert a NIfTI file to a set of DICOM files.")
+def nifti2dicom_slices(nifti, references, encode=False, template=True, window="series", rle=False, description="nifti2dicom", profile=None):
+	# yield (filename, dataset) for each DICOM file of a NIfTI image, or (filename, bytes) of the DICOM files if encode
+	# nifti is a nibabel image, the path of a NIfTI file, or an array of NIfTI data in the orientation of the reference DICOM files
+	# references are at least two DICOM datasets of the series, or the bytes of DICOM files; the first and last by Instance Number are used
+	# nothing else is read from nor written to the filesystem, and DICOM files are generated only as they are consumed
+	# datasets are yielded as copies, thus may be kept, while template applies only to bytes
+	references = sorted((_reference(reference) for reference in references), key=lambda dataset: dataset.InstanceNumber)
+	assert len(references) >= 2, "at least two reference DICOM files are required"
+	dataset1, dataset2 = references[0], references[-1]
+	if type(nifti) is str:
+		nifti = nibabel.load(nifti, keep_file_open=True)
+	elif isinstance(nifti, numpy.ndarray):
+		nifti = nibabel.Nifti1Image(nifti, dicomtools.get_affine(dataset1, dataset2)[2])
+	for dicomname, dataset, pixels in _slices(nifti, dataset1, dataset2, description, template=template and encode, window=window, rle=rle, profile=profile):
+		if encode:
+			yield dicomname, dicomtools.dcmencode(dataset, pixels)
+		else:
+			dataset = copy.deepcopy(dataset)
+			if pixels is not None:
+				dicomtools.rle_encode_dataset(dataset, pixels)
+			yield dicomname, dataset
+
+def nifti2dicom(path, jobs=1, processes=False, template=True, window="series", rle=False, profile=None, quiet=False):
+	# find NIfTI files
+	if os.path.isfile(path):
+		assert re.search("\.nii(?:\.gz)$", path, flags=re.I), "{} is not a NIfTI file".format(path)
+		niftipaths = [path]
+		dirpath = os.path.dirname(path)
+	elif os.path.isdir(path):
+		niftipaths = [os.path.join(path, filename) for filename in os.listdir(path) if re.search("\.nii(?:\.gz)$", filename, flags=re.I)]
+		dirpath = path
+	else:
+		assert False, "{} is neither a file nor a directory".format(path)
+	# find DICOM files
+	with proftools.stage(profile, "scan") as counts:
+		dicompaths = dicomtools.dir_list_files(dirpath)
+		counts["files"] = len(dicompaths)
+	assert len(dicompaths) >= 2, "directory {} must contain at least two DICOM files".format(dirpath)
+	with proftools.stage(profile, "header", files=2):
+		# read first and last DICOM files
+		dataset1 = pydicom.dcmread(dicompaths[0], stop_before_pixels=True)
+		dataset2 = pydicom.dcmread(dicompaths[-1], stop_before_pixels=True)
+	subdirpaths = []
+	with dicomtools.dcmwrite_pool(jobs, processes) as dcmwrite:
+		for nifticnt, niftipath in enumerate(niftipaths):
+			if not quiet:
+				print("reading [{}/{}] NIfTI file {}".format(nifticnt + 1, len(niftipaths), niftipath))
+			nifti = nibabel.load(niftipath, keep_file_open=True)
+			description = re.sub("\.nii(?:\.gz)$", "", os.path.split(niftipath)[-1], flags=re.I)
+			# save DICOM files
+			subdirname = dicomtools.get_series({"ProtocolName": description, "SeriesNumber": dataset1.SeriesNumber}) + datetime.datetime.now().strftime("-%Y%m%d%H%M%S")
+			subdirpath = os.path.join(dirpath, subdirname)
+			assert not os.path.exists(subdirpath)
+			os.mkdir(subdirpath)
+			subdirpaths.append(subdirpath)
+			for dicomname, dataset, pixels in _slices(nifti, dataset1, dataset2, description, template=template, window=window, rle=rle, profile=profile, dirpath=None if quiet else subdirpath):
+				with proftools.stage(profile, "write", files=1):
+					dcmwrite(os.path.join(subdirpath, dicomname), dataset, pixels)
+	if profile is not None:
+		# bytes of the DICOM files, once written by the pool
+		proftools.add(profile, "write", calls=0, bytes_written=sum(entry.stat().st_size for subdirpath in subdirpaths for entry in os.scandir(subdirpath)))
+	if not quiet:
+		print("nifti2dicom complete")
+
+def main(argv=None, prog=None):
+	parser = argparse.ArgumentParser(prog=prog, description="Convert a NIfTI file to a set of DICOM files.")
 	parser.add_argument("path", help="directory of NIfTI files or path of a NIfTI file", metavar="PATH")
-	args = parser.parse_args()
-	nifti2dicom(args.path)
+	parser.add_argument("-j", "--jobs", type=int, default=1, help="number of workers writing DICOM files; default 1")
+	parser.add_argument("-p", "--processes", action="store_true", help="use worker processes instead of threads")
+	parser.add_argument("--no-template", action="store_false", help="encode every DICOM file from scratch", dest="template")
+	parser.add_argument("-w", "--window", choices=["series", "file"], default="series", help="compute a window for the whole NIfTI file or for each DICOM file; default series")
+	parser.add_argument("--rle", action="store_true", help="write RLE Lossless compressed DICOM files")
+	parser.add_argument("-q", "--quiet", action="store_true", help="print a throughput summary instead of a line per file")
+	parser.add_argument("--profile", action="store_true", help="print the time, files and bytes of each stage")
+	parser.add_argument("--stats-json", help="save the time, files and bytes of each stage to a JSON file", metavar="PATH")
+	args = parser.parse_args(argv)
+	profile = proftools.new() if args.quiet or args.profile or args.stats_json else None
+	nifti2dicom(args.path, jobs=args.jobs, processes=args.processes, template=args.template, window=args.window, rle=args.rle, profile=profile, quiet=args.quiet)
+	if args.profile:
+		proftools.report(profile)
+	elif args.quiet:
+		print(proftools.summary(profile, "write"))
+	if args.stats_json:
+		proftools.save(profile, args.stats_json)
+
+if __name__ == "__main__":
+	main()
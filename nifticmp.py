@@ -4,31 +4,65 @@ import argparse
 import os
 import re
 
-import numpy
-import nibabel
+import lazytools
+
+numpy = lazytools.lazy_import("numpy")
+nibabel = lazytools.lazy_import("nibabel")
+
+# approximate size in bytes of the slabs compared at once
+CHUNK = 64 << 20
 
 def _path2obj(path):
 	assert os.path.isfile(path)
 	assert re.search("\.nii(?:\.gz)$", path, flags=re.I)
-	return nibabel.load(path)
-
-def cmp(nifti1, nifti2):
-	if type(nifti1) is str:
-		nifti1 = _path2obj(nifti1)
-	if type(nifti1) is not numpy.ndarray:
-		nifti1 = nifti1.get_data()
-	if type(nifti2) is str:
-		nifti2 = _path2obj(nifti2)
-	if type(nifti2) is not numpy.ndarray:
-		nifti2 = nifti2.get_data()
-	ret = numpy.all(nifti1 == nifti2)
-	if __name__ == "__main__":
-		exit(not ret)
+	return nibabel.load(path, keep_file_open=True)
+
+def _obj2data(nifti):
+	# array or array proxy, which reads only the slabs sliced from it
+	if type(nifti) is str:
+		nifti = _path2obj(nifti)
+	if type(nifti) is numpy.ndarray:
+		return nifti
+	return nifti.dataobj
+
+def cmp(nifti1, nifti2, atol=0, rtol=0, equal_nan=False, chunk=CHUNK):
+	# compare slabs along the last axis, stopping at the first differing slab
+	data1 = _obj2data(nifti1)
+	data2 = _obj2data(nifti2)
+	ret = tuple(data1.shape) == tuple(data2.shape)
+	if not ret:
+		print("shapes differ: {} {}".format(tuple(data1.shape), tuple(data2.shape)))
+	else:
+		shape = tuple(data1.shape)
+		# number of indices of the last axis per slab; scaled data are read as float64
+		nslab = max(1, chunk // (int(numpy.prod(shape[:-1], dtype=numpy.int64)) * 8))
+		for k in range(0, shape[-1], nslab):
+			slab1 = numpy.asanyarray(data1[..., k:k+nslab])
+			slab2 = numpy.asanyarray(data2[..., k:k+nslab])
+			if atol or rtol or equal_nan:
+				diff = ~numpy.isclose(slab1, slab2, rtol=rtol, atol=atol, equal_nan=equal_nan)
+			else:
+				diff = slab1 != slab2
+			if numpy.any(diff):
+				ret = False
+				# first in the order of the voxels in the NIfTI file
+				voxel = numpy.unravel_index(numpy.argmax(diff.ravel(order="F")), diff.shape, order="F")
+				voxel = tuple(int(v) for v in voxel[:-1]) + (int(voxel[-1]) + k,)
+				absdiff = numpy.abs(slab1[diff].astype(numpy.float64) - slab2[diff].astype(numpy.float64))
+				maxdiff = numpy.nan if numpy.all(numpy.isnan(absdiff)) else numpy.nanmax(absdiff)
+				print("first differing voxel {}, max abs difference {} in slab {}:{}".format(voxel, maxdiff, k, min(k + nslab, shape[-1])))
+				break
 	return ret
 
-if __name__ == "__main__":
-	parser = argparse.ArgumentParser()
+def main(argv=None, prog=None):
+	parser = argparse.ArgumentParser(prog=prog)
 	parser.add_argument("path1", help="first file path")
 	parser.add_argument("path2", help="second file path")
-	args = parser.parse_args()
-	cmp(args.path1, args.path2)
+	parser.add_argument("-a", "--atol", type=float, default=0, help="absolute tolerance; default 0")
+	parser.add_argument("-r", "--rtol", type=float, default=0, help="relative tolerance; default 0")
+	parser.add_argument("-n", "--equal-nan", action="store_true", help="consider NaN values equal")
+	args = parser.parse_args(argv)
+	exit(0 if cmp(args.path1, args.path2, atol=args.atol, rtol=args.rtol, equal_nan=args.equal_nan) else 1)
+
+if __name__ == "__main__":
+	main()
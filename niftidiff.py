@@ -3,33 +3,87 @@
 import argparse
 import os
 import re
+import gzip
+from concurrent.futures import ThreadPoolExecutor
 
-import numpy
-import nibabel
+import lazytools
 
-def _path2obj(path):
-	assert os.path.isfile(path)
-	assert re.search("\.nii(?:\.gz)$", path, flags=re.I)
-	return nibabel.load(path)
+numpy = lazytools.lazy_import("numpy")
+nibabel = lazytools.lazy_import("nibabel")
 
-def diff(nifti1, nifti2):
-	if type(nifti1) is str:
-		nifti1 = _path2obj(nifti1)
-	if type(nifti2) is str:
-		nifti2 = _path2obj(nifti2)
-	for key, value1, value2 in zip(nifti1.header.keys(), nifti1.header.values(), nifti2.header.values()):
+def read_header(path):
+	# read only the 348 bytes of the NIfTI header; gzip decompresses only as much as needed
+	assert re.search("\.nii(?:\.gz)$", path, flags=re.I), "{} is not a NIfTI file".format(path)
+	with (gzip.open(path, "rb") if re.search("\.gz$", path, flags=re.I) else open(path, "rb")) as fp:
+		arr = fp.read(nibabel.Nifti1Header.template_dtype.itemsize)
+	return nibabel.Nifti1Header(arr, check=False)
+
+def _obj2header(nifti):
+	if type(nifti) is str:
+		return read_header(nifti)
+	if isinstance(nifti, nibabel.Nifti1Header):
+		return nifti
+	return nifti.header
+
+def diff_fields(nifti1, nifti2):
+	# list of (key, value1, value2) of the differing header fields
+	header1 = _obj2header(nifti1)
+	header2 = _obj2header(nifti2)
+	fields = []
+	for key, value1, value2 in zip(header1.keys(), header1.values(), header2.values()):
 		try:
 			if not numpy.allclose(value1, value2, equal_nan=True):
-				print("< {}: {}".format(key, value1))
-				print("> {}: {}".format(key, value2))
+				fields.append((key, value1, value2))
 		except:
 			if not value1 == value2:
-				print("< {}: {}".format(key, value1))
-				print("> {}: {}".format(key, value2))
+				fields.append((key, value1, value2))
+	return fields
+
+def diff(nifti1, nifti2):
+	for key, value1, value2 in diff_fields(nifti1, nifti2):
+		print("< {}: {}".format(key, value1))
+		print("> {}: {}".format(key, value2))
+
+def _format(value):
+	if isinstance(value, numpy.ndarray):
+		value = value.tolist()
+	if type(value) is bytes:
+		value = value.decode("latin-1")
+	return re.sub("\s+", " ", str(value))
+
+def diff_table(reference, paths, jobs=1):
+	# compare the header of a reference against the headers of many NIfTI files, read by a pool of jobs threads
+	# print a table with a row per differing field, and return the number of differing NIfTI files
+	reference = _obj2header(reference)
+	if jobs > 1:
+		with ThreadPoolExecutor(jobs) as executor:
+			results = executor.map(lambda path: diff_fields(reference, path), paths)
+	else:
+		results = (diff_fields(reference, path) for path in paths)
+	print("path\tfield\treference\tvalue")
+	ndiff = 0
+	for path, fields in zip(paths, results):
+		ndiff += bool(fields)
+		for key, value1, value2 in fields:
+			print("{}\t{}\t{}\t{}".format(path, key, _format(value1), _format(value2)))
+	return ndiff
+
+def _find_niftis(path):
+	if os.path.isdir(path):
+		return sorted(os.path.join(path, filename) for filename in os.listdir(path) if re.search("\.nii(?:\.gz)$", filename, flags=re.I))
+	return [path]
+
+def main(argv=None, prog=None):
+	parser = argparse.ArgumentParser(prog=prog)
+	parser.add_argument("path1", help="first file path, or reference file path for a table")
+	parser.add_argument("path2", nargs="+", help="second file path, or file and directory paths for a table")
+	parser.add_argument("-t", "--table", action="store_true", help="output a table with a row per differing field; implied by more than one second path")
+	parser.add_argument("-j", "--jobs", type=int, default=1, help="number of threads reading NIfTI headers; default 1")
+	args = parser.parse_args(argv)
+	paths = [path for path2 in args.path2 for path in _find_niftis(path2)]
+	if args.table or len(args.path2) > 1 or os.path.isdir(args.path2[0]):
+		exit(diff_table(args.path1, paths, jobs=args.jobs) > 0)
+	diff(args.path1, args.path2[0])
 
 if __name__ == "__main__":
-	parser = argparse.ArgumentParser()
-	parser.add_argument("path1", help="first file path")
-	parser.add_argument("path2", help="second file path")
-	args = parser.parse_args()
-	diff(args.path1, args.path2)
+	main()
@@ -3,9 +3,110 @@
 import argparse
 import os
 import re
+import io
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import lazytools
+import proftools
+
+numpy = lazytools.lazy_import("numpy")
+nibabel = lazytools.lazy_import("nibabel")
+
+########
+# gzip #
+########
+
+# a .nii.gz file is written as a multi-member gzip stream, pigz-style
+# blocks of the uncompressed stream are compressed independently by a pool of threads, since zlib releases the GIL
+# any gzip reader decompresses the concatenated members as a single stream
+
+# default compression level, as nibabel
+GZIP_LEVEL = 1
+
+# size of the uncompressed blocks
+GZIP_BLOCK = 1 << 20
+
+def _gzip_member(arr, level):
+	compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+	return compressor.compress(arr) + compressor.flush()
+
+class _GzipWriter(io.RawIOBase):
+	# write-only file object compressing blocks with a pool of jobs threads
+	# seek is supported only to the current position, which is enough for nibabel
+
+	def __init__(self, path, level=GZIP_LEVEL, jobs=1, block=GZIP_BLOCK, profile=None):
+		self._fp = open(path, "wb")
+		self._level = level
+		self._profile = profile
+		self._block = block
+		self._buffer = bytearray()
+		self._pos = 0
+		self._executor = ThreadPoolExecutor(jobs) if jobs > 1 else None
+		self._inflight = 2 * jobs
+		self._futures = deque()
+
+	def writable(self):
+		return True
+
+	def tell(self):
+		return self._pos
+
+	def seek(self, offset, whence=io.SEEK_SET):
+		if whence == io.SEEK_CUR:
+			offset += self._pos
+		if whence == io.SEEK_END or offset != self._pos:
+			raise io.UnsupportedOperation("can not seek a gzip stream being written")
+		return self._pos
+
+	def _compress(self, arr):
+		# timed in the thread compressing the block
+		with proftools.stage(self._profile, "compress", bytes_read=len(arr)) as counts:
+			member = _gzip_member(arr, self._level)
+			counts["bytes_written"] = len(member)
+		return member
+
+	def _submit(self, arr):
+		if self._executor is None:
+			self._fp.write(self._compress(arr))
+			return
+		if len(self._futures) >= self._inflight:
+			self._fp.write(self._futures.popleft().result())
+		self._futures.append(self._executor.submit(self._compress, arr))
+
+	def write(self, arr):
+		arr = memoryview(arr).cast("B")
+		self._buffer += arr
+		self._pos += len(arr)
+		while len(self._buffer) >= self._block:
+			self._submit(bytes(self._buffer[:self._block]))
+			del self._buffer[:self._block]
+		return len(arr)
+
+	def close(self):
+		if self.closed:
+			return
+		try:
+			if self._buffer or not self._pos:
+				self._submit(bytes(self._buffer))
+			while self._futures:
+				self._fp.write(self._futures.popleft().result())
+		finally:
+			if self._executor is not None:
+				self._executor.shutdown()
+			self._fp.close()
+			super().close()
+
+def save(nifti, path, level=GZIP_LEVEL, jobs=1, profile=None):
+	# as nibabel.save, compressing a .nii.gz file with a pool of jobs threads
+	if not re.search("\.nii\.gz$", path, flags=re.I):
+		nibabel.save(nifti, path)
+		return
+	with _GzipWriter(path, level=level, jobs=jobs, profile=profile) as fp:
+		fileholder = nibabel.FileHolder(filename=path, fileobj=fp)
+		nifti.to_file_map({"header": fileholder, "image": fileholder})
 
-import numpy
-import nibabel
 
 def file_is_valid(filename):
 	if not os.path.isfile(filename):
@@ -14,20 +115,70 @@ def file_is_valid(filename):
 		return False
 	return True
 
-def orient(nifti, outpath=None, diagonal=False):
+def orient(nifti, outpath=None, diagonal=False, level=GZIP_LEVEL, jobs=1):
 	if type(nifti) is str:
 		nifti = nibabel.load(nifti)
 	nifti = nibabel.as_closest_canonical(nifti, diagonal)
 	if outpath is not None:
-		nibabel.save(nifti, outpath)
+		save(nifti, outpath, level=level, jobs=jobs)
 	return nifti
 
-def autowindowing(nifti):
+def reorient_shape(shape, ornt):
+	# shape of an image after nibabel.orientations.apply_orientation(image, ornt)
+	newshape = list(shape)
+	for axis, (newaxis, flip) in enumerate(ornt):
+		newshape[int(newaxis)] = shape[axis]
+	return tuple(newshape)
+
+def reoriented_slices(nifti, ornt):
+	# yield the slices along the last axis of nifti.as_reoriented(ornt)
+	# only one slice at a time is read from nifti.dataobj, thus memory is bounded regardless of the number of slices
+	# load nifti with keep_file_open=True, otherwise each slice of a compressed file is decompressed from the start
 	if type(nifti) is str:
-		nifti = nibabel.load(nifti)
-	data = nifti.get_data().flatten()
-	if data.size > 1<<16:
-		data = numpy.random.choice(data, 1<<16)
+		nifti = nibabel.load(nifti, keep_file_open=True)
+	dataobj = nifti.dataobj
+	ndim = len(nifti.shape)
+	ornt = numpy.array(ornt)
+	# axes beyond ornt, e.g. time, are kept as is
+	ornt = numpy.concatenate((ornt, [[axis, 1] for axis in range(len(ornt), ndim)])) if len(ornt) < ndim else ornt
+	# input axis which becomes the last axis
+	axis = int(numpy.flatnonzero(ornt[:, 0] == ndim - 1)[0])
+	flip = ornt[axis, 1] < 0
+	# images in memory, e.g. of Nifti1Image.from_bytes, have no filename
+	filename = nifti.get_filename()
+	if flip and nibabel.is_proxy(dataobj) and filename is not None and re.search("\.gz$", filename, flags=re.I):
+		# a compressed file can not be read backwards one slice at a time
+		dataobj = numpy.asanyarray(dataobj)
+	ornt = numpy.delete(ornt, axis, axis=0)
+	n = nifti.shape[axis]
+	index = [slice(None)] * ndim
+	for f in range(n):
+		index[axis] = n - 1 - f if flip else f
+		yield nibabel.orientations.apply_orientation(numpy.asanyarray(dataobj[tuple(index)]), ornt)
+
+# number of voxels sampled for windowing
+SAMPLES = 1 << 16
+
+# approximate size in bytes of the slabs read at once; scaled data are read as float64
+CHUNK = 64 << 20
+
+def sample(data, n=SAMPLES, seed=0, chunk=CHUNK):
+	# stratified sample of n voxels of an array or array proxy, with replacement
+	# slabs along the last axis are read one at a time and each contributes in proportion to its size
+	shape = data.shape
+	if numpy.prod(shape) <= n:
+		return numpy.asanyarray(data).flatten()
+	random = numpy.random.RandomState(seed)
+	nslab = max(1, chunk // (int(numpy.prod(shape[:-1])) * 8))
+	samples = []
+	for k in range(0, shape[-1], nslab):
+		slab = numpy.asanyarray(data[..., k:k+nslab]).reshape(-1)
+		m = n * min(k + nslab, shape[-1]) // shape[-1] - n * k // shape[-1]
+		samples.append(slab[random.randint(0, slab.size, m)])
+	return numpy.concatenate(samples)
+
+def window(data):
+	# window center and width from the histogram of data
 	hist, bins = numpy.histogram(data, bins=1<<8)
 	if hist[-2]:
 		# marks are not separated
@@ -45,8 +196,23 @@ def autowindowing(nifti):
 			maxval = bins[-1]
 	return (minval + maxval) / 2, maxval - minval
 
-if __name__ == "__main__":
-	parser = argparse.ArgumentParser()
+def autowindowing(nifti, axis=None, seed=0):
+	# window center and width of a sample of the voxels of a NIfTI image or an array
+	# in case axis is given, e.g. 2 for slices or 3 for volumes, return a list of windows along axis
+	if type(nifti) is str:
+		nifti = nibabel.load(nifti, keep_file_open=True)
+	data = nifti if type(nifti) is numpy.ndarray else nifti.dataobj
+	if axis is None:
+		return window(sample(data, seed=seed))
+	windows = []
+	index = [slice(None)] * len(data.shape)
+	for k in range(data.shape[axis]):
+		index[axis] = k
+		windows.append(window(sample(numpy.asanyarray(data[tuple(index)]), seed=seed)))
+	return windows
+
+def main(argv=None, prog=None):
+	parser = argparse.ArgumentParser(prog=prog)
 	subparsers = parser.add_subparsers(dest="action", help="one of the following actions", metavar="ACTION")
 	subparsers.required = True
 	parser_header = subparsers.add_parser("header", description="Output the header of a NIfTI file.", help="output the header of a NIfTI file")
@@ -57,7 +223,9 @@ if __name__ == "__main__":
 	parser_orient.add_argument("inpath", help="path to the input NIfTI file", metavar="INPATH")
 	parser_orient.add_argument("-o", "--outpath", help="path to the output NIfTI file; default INPATH-oriented")
 	parser_orient.add_argument("-d", "--diagonal", action="store_true", help="apply orientation only if resulting affine is close to diagonal")
-	args = parser.parse_args()
+	parser_orient.add_argument("-z", "--level", type=int, default=GZIP_LEVEL, help="gzip compression level of the output NIfTI file; default {}".format(GZIP_LEVEL))
+	parser_orient.add_argument("-j", "--jobs", type=int, default=1, help="number of threads compressing the output NIfTI file; default 1")
+	args = parser.parse_args(argv)
 	if args.action == "header":
 		nifti = nibabel.load(args.path)
 		print(nibabel.volumeutils.pretty_mapping(nifti.get_header()))
@@ -67,4 +235,7 @@ if __name__ == "__main__":
 	elif args.action == "orient":
 		if args.outpath is None:
 			args.outpath = re.sub("(\.nii(?:\.gz))$", "-oriented\\1", args.inpath, flags=re.I)
-		orient(args.inpath, outpath=args.outpath, diagonal=args.diagonal)
+		orient(args.inpath, outpath=args.outpath, diagonal=args.diagonal, level=args.level, jobs=args.jobs)
+
+if __name__ == "__main__":
+	main()
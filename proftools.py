@@ -0,0 +1,107 @@
+#!/usr/bin/python3
+
+import argparse
+import sys
+import time
+import json
+import threading
+import contextlib
+
+# a profile is a dict of stages, each accumulating wall and CPU time, calls, files and bytes
+# wall time is measured with time.perf_counter, CPU time with time.thread_time of the thread running the stage,
+# thus the work of pools of threads or processes is not included, unless it is timed by the pool itself, e.g. compress
+# stages may nest, e.g. mosaic within decode, or compress within write
+# functions accept None as profile, in which case nothing is recorded
+
+_lock = threading.Lock()
+
+_fields = ["calls", "wall", "cpu", "files", "bytes_read", "bytes_written"]
+
+def new():
+	return {"argv": sys.argv, "start": time.time(), "wall": 0, "stages": {}}
+
+def add(profile, name, calls=1, wall=0, cpu=0, files=0, bytes_read=0, bytes_written=0):
+	if profile is None:
+		return
+	with _lock:
+		stage = profile["stages"].setdefault(name, dict.fromkeys(_fields, 0))
+		stage["calls"] += calls
+		stage["wall"] += wall
+		stage["cpu"] += cpu
+		stage["files"] += files
+		stage["bytes_read"] += bytes_read
+		stage["bytes_written"] += bytes_written
+		profile["wall"] = time.time() - profile["start"]
+
+@contextlib.contextmanager
+def stage(profile, name, files=0, bytes_read=0, bytes_written=0):
+	# time the body; counts may be updated by the body, e.g. counts["bytes_written"] += len(arr)
+	counts = {"files": files, "bytes_read": bytes_read, "bytes_written": bytes_written}
+	if profile is None:
+		yield counts
+		return
+	wall, cpu = time.perf_counter(), time.thread_time()
+	try:
+		yield counts
+	finally:
+		add(profile, name, wall=time.perf_counter() - wall, cpu=time.thread_time() - cpu, **counts)
+
+def iterate(profile, name, iterable):
+	# time each step of an iterable, counting the bytes of the yielded arrays as read
+	if profile is None:
+		yield from iterable
+		return
+	iterator = iter(iterable)
+	while True:
+		wall, cpu = time.perf_counter(), time.thread_time()
+		try:
+			item = next(iterator)
+		except StopIteration:
+			return
+		add(profile, name, wall=time.perf_counter() - wall, cpu=time.thread_time() - cpu, bytes_read=getattr(item, "nbytes", 0))
+		yield item
+
+def _rate(n, seconds):
+	return n / seconds if seconds > 0 else float("nan")
+
+def report(profile, fp=None):
+	# a table with a row per stage, in order of first use
+	if fp is None:
+		fp = sys.stdout
+	fp.write("stage\tcalls\twall\tcpu\tfiles\tMB_read\tMB_written\tfiles/s\tMB/s\n")
+	for name, stage in profile["stages"].items():
+		mb = (stage["bytes_read"] + stage["bytes_written"]) / 1e6
+		fp.write("{}\t{}\t{:.3f}\t{:.3f}\t{}\t{:.1f}\t{:.1f}\t{:.1f}\t{:.1f}\n".format(
+			name, stage["calls"], stage["wall"], stage["cpu"], stage["files"],
+			stage["bytes_read"] / 1e6, stage["bytes_written"] / 1e6,
+			_rate(stage["files"], stage["wall"]), _rate(mb, stage["wall"])
+		))
+	fp.write("total\t\t{:.3f}\n".format(profile["wall"]))
+
+def summary(profile, name):
+	# throughput of a stage over the whole run
+	stage = profile["stages"].get(name, dict.fromkeys(_fields, 0))
+	wall = time.time() - profile["start"]
+	mb = (stage["bytes_read"] + stage["bytes_written"]) / 1e6
+	return "{} {} files, {:.1f} MB in {:.2f} s: {:.1f} files/s, {:.1f} MB/s".format(name, stage["files"], mb, wall, _rate(stage["files"], wall), _rate(mb, wall))
+
+def save(profile, path):
+	profile["wall"] = time.time() - profile["start"]
+	with open(path, "w") as fp:
+		json.dump(profile, fp, indent=1)
+
+def load(path):
+	with open(path) as fp:
+		return json.load(fp)
+
+def main(argv=None, prog=None):
+	parser = argparse.ArgumentParser(prog=prog, description="Print the table of stages of profiles saved with --stats-json.")
+	parser.add_argument("path", nargs="+", help="JSON files of profiles", metavar="PATH")
+	args = parser.parse_args(argv)
+	for path in args.path:
+		profile = load(path)
+		print("# {}: {}".format(path, " ".join(profile["argv"])))
+		report(profile)
+
+if __name__ == "__main__":
+	main()
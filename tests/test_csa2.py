@@ -0,0 +1,66 @@
+from collections import OrderedDict
+
+import pytest
+
+import dicombench
+import dicomsynth
+import dicomtools
+
+# items of the CSA Image Header Info which vary between the DICOM files of a mosaic, as patched by nifti2dicom
+_slice_keys = ["Actual3DImaPartNumber", "ProtocolSliceNumber", "SlicePosition_PCS", "TimeAfterStart"]
+
+@pytest.fixture(scope="module")
+def mosaic():
+	# CSA Image Header Info of the DICOM files of a synthetic mosaic
+	return [dataset[0x0029, 0x1010].value for filename, dataset in dicomsynth.synth_series("mosaic", nslices=16, size=32, nvolumes=4)]
+
+def _header():
+	# header with empty items, items of each length modulo 4, and tags without items
+	hdr = OrderedDict()
+	for k in range(12):
+		hdr["Tag{:02d}".format(k)] = {"VM": k % 4, "VR": "DS", "SyngoDT": 3, "Data": [("x" * (k + c) if c % 3 else None) for c in range(k % 4)]}
+	return hdr
+
+def test_decode_encode(mosaic):
+	for arr in mosaic:
+		hdr = dicomtools.csa2_decode(arr)
+		assert hdr["NumberOfImagesInMosaic"]["Data"] == ["16"]
+		assert hdr == dicombench._csa2_decode_ref(arr)
+		assert dicomtools.csa2_encode(hdr) == arr
+		assert dicombench._csa2_encode_ref(hdr) == arr
+
+def test_encode_decode():
+	hdr = _header()
+	arr = dicomtools.csa2_encode(hdr)
+	# header, tags of 84 bytes, items of 16 bytes padded to 4 bytes, and a trailing zero
+	assert len(arr) == 16 + sum(84 + sum(16 + (len(dat) + 4) // 4 * 4 if dat is not None else 16 for dat in val["Data"]) for val in hdr.values()) + 4
+	assert arr == dicombench._csa2_encode_ref(hdr)
+	assert dicomtools.csa2_decode(arr) == hdr
+	assert dicomtools.csa2_encode(dicomtools.csa2_decode(arr)) == arr
+
+def test_decode_keys(mosaic):
+	hdr = dicomtools.csa2_decode(mosaic[0])
+	keys = ["SliceNormalVector", "NumberOfImagesInMosaic"]
+	assert dicomtools.csa2_decode(mosaic[0], keys=keys) == OrderedDict((key, hdr[key]) for key in hdr if key in keys)
+
+def test_patch(mosaic):
+	# patching the header of the first DICOM file with the slice items of another one gives the header of the latter
+	arr = bytearray(mosaic[0])
+	offsets = dicomtools.csa2_offsets(arr)
+	for other in mosaic[1:]:
+		hdr = dicomtools.csa2_decode(other)
+		assert dicomtools.csa2_patch(arr, offsets, hdr, _slice_keys)
+		assert bytes(arr) == other
+
+def test_patch_length():
+	hdr = _header()
+	arr = bytearray(dicomtools.csa2_encode(hdr))
+	offsets = dicomtools.csa2_offsets(arr)
+	# items of the same padded length are patched in place
+	hdr["Tag06"]["Data"][1] = "y" * 6
+	assert dicomtools.csa2_patch(arr, offsets, hdr, ["Tag06"])
+	assert bytes(arr) == dicomtools.csa2_encode(hdr)
+	# a longer item, an empty item or another number of items does not fit
+	for data in [[None, "x" * 16], [None, None], ["x" * 6]]:
+		hdr["Tag06"]["Data"] = data
+		assert not dicomtools.csa2_patch(bytearray(arr), offsets, hdr, ["Tag06"])
@@ -0,0 +1,13 @@
+import pydicom
+
+import dicomsynth
+import dicomtools
+
+def test_dir_list_files_empty_instance_number(tmp_path):
+	# a file with an empty Instance Number is skipped, whether its header is parsed or taken from the index
+	dicompaths = dicomsynth.synth(str(tmp_path), nslices=12, size=16)
+	dataset = pydicom.dcmread(dicompaths[0])
+	dataset.InstanceNumber = None
+	dataset.save_as(dicompaths[0])
+	for i in range(2):
+		assert dicomtools.dir_list_files(str(tmp_path)) == dicompaths[1:]
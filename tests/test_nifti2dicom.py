@@ -0,0 +1,34 @@
+import io
+
+import numpy
+import pydicom
+import pytest
+
+import dicomsynth
+import nifti2dicom
+
+def _references(kind, loaded):
+	# reference DICOM files of a synthetic series, read with or without their pixel data
+	references = []
+	for filename, dataset in dicomsynth.synth_series(kind, nslices=9, size=32, nvolumes=3):
+		fp = io.BytesIO()
+		dataset.save_as(fp, write_like_original=False)
+		references.append(pydicom.dcmread(io.BytesIO(fp.getvalue()), stop_before_pixels=not loaded))
+	return references
+
+@pytest.mark.parametrize("kind", dicomsynth.KINDS)
+@pytest.mark.parametrize("loaded", [False, True])
+@pytest.mark.parametrize("encode", [False, True])
+def test_slices_rle(kind, loaded, encode):
+	# RLE Lossless DICOM files of references read with their pixel data, e.g. by pydicom.dcmread(path)
+	shape = (32, 32, 9, 3) if kind == "mosaic" else (32, 32, 9)
+	data = numpy.random.RandomState(0).randint(0, 1000, shape).astype(numpy.int16)
+	references = _references(kind, loaded)
+	expected = [dataset.pixel_array for dicomname, dataset in nifti2dicom.nifti2dicom_slices(data, references)]
+	slices = list(nifti2dicom.nifti2dicom_slices(data, references, encode=encode, rle=True))
+	assert len(slices) == len(expected)
+	for (dicomname, dataset), pixel_array in zip(slices, expected):
+		if encode:
+			dataset = pydicom.dcmread(io.BytesIO(dataset))
+		assert dataset.file_meta.TransferSyntaxUID == pydicom.uid.RLELossless
+		assert numpy.array_equal(dataset.pixel_array, pixel_array)
@@ -0,0 +1,46 @@
+import importlib
+
+import numpy
+import pytest
+
+import dicomtools
+
+# the pydicom encoder and decoder the vectorized encoder must match byte for byte
+rle_handler = importlib.import_module("pydicom.pixel_data_handlers.rle_handler")
+
+def _rows(columns):
+	# rows of a frame with runs and literals of every kind around the PackBits limit of 128 bytes
+	random = numpy.random.RandomState(columns)
+	rows = [
+		numpy.zeros(columns), # a single run
+		numpy.arange(columns), # a single literal
+		random.randint(0, 4, columns), # short runs and literals
+		numpy.resize([0, 1, 1], columns), # single-byte literals between runs of 2
+		numpy.resize([5, 6, 7, 7, 7], columns), # literals of 2 bytes between runs of 3
+	]
+	for n in [127, 128, 129, 130, 255, 256, 257, 300]:
+		# runs and literals of n bytes
+		rows.append(numpy.resize(numpy.repeat([1, 2], n), columns))
+		rows.append(numpy.resize(numpy.concatenate([random.randint(0, 256, n), numpy.full(n, 9)]), columns))
+	return numpy.array(rows)
+
+def _check(arr):
+	frame = dicomtools.rle_encode_frame(arr)
+	assert frame == rle_handler.rle_encode_frame(arr)
+	decoded = rle_handler._rle_decode_frame(frame, arr.shape[0], arr.shape[1], 1, arr.dtype.itemsize * 8)
+	assert numpy.array_equal(numpy.frombuffer(decoded, arr.dtype.newbyteorder("<")).reshape(arr.shape), arr)
+
+@pytest.mark.parametrize("columns", [1, 2, 3, 127, 128, 129, 255, 257, 301])
+@pytest.mark.parametrize("dtype", [numpy.uint8, numpy.int16, numpy.uint16])
+def test_encode_frame(columns, dtype):
+	arr = _rows(columns)
+	if numpy.dtype(dtype).itemsize == 2:
+		# 16-bit samples, with high bytes of runs and literals too
+		arr = arr * 257 - 1000 if numpy.dtype(dtype).kind == "i" else arr * 257
+	_check(arr.astype(dtype))
+
+def test_encode_frame_mr():
+	# a slice resembling an MR image: an empty background around a noisy disk
+	y, x = numpy.mgrid[:255, :255] - 127
+	arr = numpy.where(numpy.hypot(x, y) < 100, numpy.random.RandomState(0).randint(200, 1200, (255, 255)), 0).astype(numpy.int16)
+	_check(arr)